@@ -1,12 +1,29 @@
 import os
+import io
 import time
 import json
+import datetime
 import sys
+import argparse
+import tracemalloc
 import psycopg2
-import pandas as pd
+from psycopg2.extras import Json
 import numpy as np
 from itertools import product
+import bson
+from bson.raw_bson import RawBSONDocument
 import pymongo
+from pymongo.read_concern import ReadConcern
+from pymongo.write_concern import WriteConcern
+from _query_optimizer import optimize_query
+from _result_cache import ResultCache
+from _servers import LocalShardedCluster, LocalPostgresServer, LocalMongoServer, host_metadata, pin_client
+from _load_clients import LoadClients, postgres_load_client, mongodb_load_client
+from _history import ResultsHistory, git_commit, print_comparison
+from _histogram import LatencyHistogram
+from _parameters import find_parameters, bind_parameters, choose_values
+from _jsonb import translate_query, lookup_indexes, table_name, quote_literal, SCHEMA
+from _profiling import QueryProfiler
 
 class Experiment:
 
@@ -19,14 +36,32 @@ class Experiment:
         self.postgres_settings = None
         self.mongodb_settings = None
         self.mongoclient = None
+        self.mongoclients = {}
         self.mongodb = None
+        self.mongodb_host = None
+        self.mongodb_nodes = None
         self.postgres_con = None
         self.postgres_cur = None
+        self.postgres_nodes = None
+        self.path_queries = None
+        self.path_data = ''
+        self.clusters = {}
+        self.local_servers = {}
+        self.metadata = {}
+        self.run_id = None
 
         # Set class variables
 
-        # Data frame for eperiment logging
-        self.results = pd.DataFrame(columns = ["person", "data_set", "data_store", "data_size", "query", "trial", "response_time"])
+        # Rows of the experiment logging, turned into a data frame by get_results
+        self.result_columns = ["person", "data_set", "data_store", "data_size", "query", "trial", "response_time", "status", "postgres_config", "mongodb_options", "query_variant", "cache_mode", "cache_hit", "nodes", "materialization", "conversion_time", "peak_memory", "concurrency", "selectivity", "result_rows", "durability"]
+        self.results = []
+
+        # Rows of the logging of the phases of each import per table, turned into a data frame by get_import_results
+        self.import_columns = ["person", "data_set", "data_store", "data_size", "nodes", "durability", "table", "phase", "bytes", "rows", "response_time"]
+        self.import_results = []
+
+        # Phases of the import that run in the client, the other phases run in the database server
+        self.client_phases = ['read', 'parse', 'encode', 'convert']
 
         # Dictionary with data_set names
         self.data_set = {0: "arrest_db",
@@ -43,37 +78,311 @@ class Experiment:
         self.data_store = {0: 'relational',
                            1: 'document'}
 
+        # Dictionary with the data stores a run adds when it selects them, jsonb stores the documents in postgres jsonb columns
+        self.optional_data_stores = {2: 'jsonb'}
+
+        # Dictionary with the data model of each data_store, stores of the same model import the same files
+        self.data_model = {0: 'relational',
+                           1: 'document',
+                           2: 'document'}
+
         # Dictionary with query ids
         self.query = {i:str(i) for i in range(12)}
         self.query[0]='import'
 
+        # List of full-text search query ids: keyword, keywords, phrase and ranked top 10, they need the expression
+        # indexes of text_search_tables.txt in postgres and the text indexes in mongoDB, which are built on import
+        # The query families are not in a default run, add_queries or the queries of a config add them
+        self.text_queries = [12, 13, 14, 15]
+
+        # List of time-range query ids of the arrest data set: a date range, rollups per month and per month and precinct,
+        # and a rolling 7 day average, they need a copy of arrest_info with ARREST_DATE as a date in mongoDB and the date indexes,
+        # which are built on import
+        self.time_queries = [16, 17, 18, 19]
+
         # Dictionary with trail ids
         self.trail = {i:str(i+1) for i in range(10)}
 
+        # Dictionary with session settings for postgres, e.g. {'work_mem': '64MB', 'jit': False}
+        # Config 0 runs with the server settings, add configs to sweep them as a dimension
+        self.postgres_config = {0: {}}
+
+        # Dictionary with options for mongoDB queries, e.g. {'allowDiskUse': True, 'batchSize': 1000, 'readConcern': 'majority',
+        # 'compressors': 'zstd', 'hint': {'arrest_info': {'$natural': 1}}} with hints per collection
+        # Options 0 runs with the driver defaults, add option sets to sweep them as a dimension
+        self.mongodb_options = {0: {}}
+
+        # Dictionary with query variants, add 1: 'optimized' to also run the optimized form of each query,
+        # 2: 'precomputed' to also read the aggregate queries from summaries refreshed after each import
+        # and 3: 'parameterized' to also run the queries with predicates on values drawn per trial from the loaded data
+        # Set before prepare_databases, these variants need extra columns, indexes and views
+        self.query_variant = {0: 'original'}
+
+        # Schema with the copies of the tables that the optimized queries add typed columns and indexes to, and their names
+        self.optimized_schema = 'optimized'
+        self.optimized_tables = []
+
+        # List of aggregate query ids that get a precomputed summary
+        self.precomputed_queries = [10, 11]
+
+        # Dictionary with cache modes, add 1: 'cached' to also time each query through the result cache
+        self.cache_mode = {0: 'direct'}
+
+        # Dictionary with layouts by number of nodes: hash partitions in postgres and shards in mongoDB
+        # Add e.g. 1: 2 to also run on two nodes, mongoDB uses mongodb_settings['sharded_hosts'][2] if given,
+        # otherwise a local cluster is started
+        self.nodes = {0: 1}
+
+        # Dictionary with the form in which results are materialized: 'rows' as tuples and dicts from the drivers,
+        # add 1: 'numpy' for a dictionary of NumPy arrays per column and 2: 'arrow' for an Arrow table (needs pyarrow)
+        self.materialization = {0: 'rows'}
+
+        # Dictionary with the number of clients that run each query at the same time, add e.g. 1: 4 to also time
+        # the trials while 3 load clients repeat the same query in separate processes
+        self.concurrency = {0: 1}
+
+        # Dictionary with the fraction of rows each parameter of the parameterized queries selects, None draws one
+        # random value per parameter, add e.g. 1: 0.001, 2: 0.01, 3: 0.1 and 4: 0.5 to sweep the selectivity
+        self.selectivity = {0: None}
+
+        # Dictionary with the durability of the import: 'unlogged' tables and 'synchronous_commit' in postgres and the jsonb store,
+        # write concern 'w' and 'j' in mongoDB. Durability 0 imports with the server defaults, add e.g. 1: {'synchronous_commit': False},
+        # 2: {'unlogged': True}, 3: {'w': 0}, 4: {'w': 1, 'j': False} and 5: {'w': 'majority', 'j': True} to sweep them
+        # Each setting imports the data again, a setting only runs on the stores it has options for
+        self.durability = {0: {}}
+
+        # Options of the durability settings per data store
+        self.postgres_durability = ['unlogged', 'synchronous_commit']
+        self.mongodb_durability = ['w', 'j']
+
+        # Dictionary with the partition key of the partitioned postgres tables
+        self.partition_keys = {'arrest_info': 'arrest_key',
+                               'arrest_person': 'arrest_key',
+                               'all_comments': 'comment_id'}
+
+        # Dictionary with the hashed shard key of the sharded mongoDB collections
+        self.shard_keys = {'arrest_info': 'ARREST_KEY',
+                           'arrest_info_dates': 'ARREST_KEY',
+                           'arrest_person': 'ARREST_KEY',
+                           'all_comments': '_id'}
+
+        # Dictionary with the keys of the text index per mongoDB collection, built after each import when text queries run
+        self.text_indexes = {'arrest_info': [('PD_DESC', 'text'), ('OFNS_DESC', 'text')],
+                             'all_comments': [('text', 'text')],
+                             'movies_info': [('plot', 'text'), ('fullplot', 'text')]}
+
+        # Whether the run has text queries, set by prepare_databases
+        self.text_search = False
+
+        # Dictionary with the copy of a mongoDB collection that the time-range queries read, with the format of its date fields
+        # The copy stores the dates as dates and is only made when time-range queries run, the collection itself keeps the strings
+        self.date_collections = {'arrest_info': ('arrest_info_dates', {'ARREST_DATE': '%m/%d/%Y'})}
+
+        # Dictionary with the keys of the date indexes per copy, built after each import when time-range queries run
+        self.date_indexes = {'arrest_info_dates': [[('ARREST_DATE', 1)]]}
+
+        # Index methods of the date indexes in postgres from time_range_tables.txt, 'brin' and 'btree', leave one out to compare them
+        self.time_index_methods = ['brin', 'btree']
+
+        # Whether the run has time-range queries, set by prepare_databases
+        self.time_range = False
+
         # Dictionary of query strings
-        self.query_strings = {0: {0: [], 1: []},
-                              1: {0: [], 1: []}}
+        self.query_strings = {0: {0: [], 1: [], 2: []},
+                              1: {0: [], 1: [], 2: []}}
+
+        # Dictionary of optimized query strings, left empty for stores without an optimized variant
+        self.optimized_query_strings = {0: {0: [], 1: [], 2: []},
+                                        1: {0: [], 1: [], 2: []}}
+
+        # Dictionary of query strings that read the summaries, None for queries without a summary
+        self.precomputed_query_strings = {0: {0: [], 1: [], 2: []},
+                                          1: {0: [], 1: [], 2: []}}
+
+        # Dictionary of parameterized query strings, None for queries without predicates
+        self.parameterized_query_strings = {0: {0: [], 1: [], 2: []},
+                                            1: {0: [], 1: [], 2: []}}
+
+        # Dictionary with the fields that the jsonb tables of each data set join on, they get an expression index
+        self.jsonb_indexes = {}
+
+        # Dictionary with the table and column of each parameter per data set and data model
+        self.query_parameters = {}
+
+        # Distinct values of each parameter with their row counts per data store, sampled after each import
+        self.value_pools = {}
+
+        # Values of the parameters of the current trial, drawn from the pools with a generator seeded per trial
+        self.parameter_seed = 0
+        self.trial_values = {}
 
         # List of dimension space of the experiment
-        self.dimensions = [self.data_set.keys(), self.data_store.keys(), self.data_size.keys(), self.query.keys(), self.trail.keys()]
+        self.dimensions = [self.data_set.keys(), self.data_store.keys(), self.data_size.keys(), self.query.keys(), self.trail.keys(), self.postgres_config.keys(), self.mongodb_options.keys(), self.query_variant.keys(), self.cache_mode.keys(), self.nodes.keys(), self.materialization.keys(), self.concurrency.keys(), self.selectivity.keys(), self.durability.keys()]
+
+        # Names of the dimensions, used to filter the cases of a run
+        self.dimension_names = ['data_set', 'data_store', 'data_size', 'query', 'trial', 'postgres_config', 'mongodb_options', 'query_variant', 'cache_mode', 'nodes', 'materialization', 'concurrency', 'selectivity', 'durability']
+
+        # Order in which the dimensions are looped over, from outer to inner loop
+        self.loop_order = [0, 1, 9, 2, 13, 3, 7, 12, 8, 10, 11, 5, 6, 4]
+
+        # Dimensions that need a data reload when they change, the planner always loops over them outermost
+        self.data_dimensions = [0, 1, 2, 9, 13]
+
+        # Dictionary with the ids to run per dimension name, e.g. {'query': [7], 'data_size': [3]}, other dimensions run all ids
+        self.filters = {}
+
+        # Filters that prepare_databases prepared the stores, tables and indexes for, a run cannot plan beyond them
+        self.prepared_filters = {}
+
+        # Ids per dimension of the cases planned by the current run
+        self.plan_keys = None
+
+        # Data loaded in each data store as (data_set, data_size, nodes, durability), a run only imports data that is not loaded yet
+        self.loaded = {}
+
+        # Record the peak Python memory of each trial with tracemalloc, this slows down the trials it measures
+        self.trace_memory = False
+
+        # Profile the client per query and data size, e.g. {'path': 'profiles', 'interval': 1} with the stack sampling interval in ms
+        # Each query runs once more after its trials under cProfile and a stack sampler, add 'trials': True to profile the timed
+        # trials instead, their response times then include the overhead of the profiler. None disables profiling
+        self.profile = None
+
+        # Profiler of the current query and the time per category of each profiled query
+        self.profiler = None
+        self.profiles = []
+
+        # Column types of the postgres queries, described once per catalog entry for the columnar materializations
+        self.column_types = {}
+
+        # Time spent converting the result of the current trial into its materialization, and its number of rows
+        self.conversion_time = None
+        self.result_rows = None
+
+        # Time budget per query in ms, applied as statement_timeout in postgres and maxTimeMS in mongoDB (None disables it)
+        self.time_budget = 2000
+
+        # Smallest data_size index at which a query exceeded its time budget
+        self.timed_out = {}
 
-        # List of all combinations in the dimension space of the experiment
-        self.cases = list(product(*self.dimensions))
+        # Latency histograms of the completed trials and of the load clients per query, data size and config of the last execution
+        self.histograms = {}
+        self.load_histograms = {}
 
-        # Initialize cache
-        self.cache = []
+        # Time in s the load clients ran per query, data size and config, for their throughput
+        self.load_durations = {}
+
+        # Interval in ms at which each load client starts a query, None runs them in a closed loop
+        # With an interval the load latencies are corrected for coordinated omission
+        self.load_interval = None
+
+        # Read-through cache of query results, emptied whenever the data changes
+        self.result_cache = ResultCache(max_bytes=256*1024**2)
+
+        # Cache hits of the trials of the current query
+        self.cache_hits = []
+
+        # Load clients of the current query when it runs with concurrency, and whether they failed to start
+        self.load_clients = None
+        self.load_failed = False
 
         print('Created instance of Experiment class to measure database response times')
 
+    def add_queries(self, queries):
+
+        # Add the ids of the optional query families to the query dimension
+        for query in queries:
+            if (query in self.text_queries) or (query in self.time_queries):
+                self.query[query] = str(query)
+
+    def planned_keys(self, dimension, filters):
+
+        return [key for key in self.dimensions[dimension] if (self.dimension_names[dimension] not in filters) or (key in filters[self.dimension_names[dimension]])]
+
+    def skip_case(self, case):
+
+        # Postgres configs only apply to postgres, including the jsonb store
+        if (case[1] == 1) & (case[5] != 0):
+            return True
+
+        # MongoDB options only apply to mongoDB
+        if (case[1] != 1) & (case[6] != 0):
+            return True
+
+        # Skip queries and variants that are not available for this data set and store, e.g. the time-range queries of the arrest data set only
+        if (case[3] != 0) & (not self.has_query(case)):
+            return True
+
+        # Selectivities only apply to the parameterized queries
+        if (self.selectivity[case[12]] is not None) & (self.query_variant[case[7]] != 'parameterized'):
+            return True
+
+        # Arrow tables need pyarrow
+        if self.materialization[case[10]] == 'arrow':
+            from _materialize import has_pyarrow
+            if not has_pyarrow():
+                return True
+
+        return False
+
+    def skip_durability(self, data_store, durability):
+
+        # Durability settings only apply to the stores they have options for, the server defaults apply to every store
+        settings = self.durability[durability]
+        names = self.mongodb_durability if data_store == 1 else self.postgres_durability
+
+        return (len(settings) > 0) and not any(name in settings for name in names)
+
+    def plan_cases(self, filters=None):
+
+        # Generate the cases of a run one at a time, only for the filtered ids of each dimension
+        filters = self.filters if filters is None else filters
+        self.plan_keys = [self.planned_keys(dimension, filters) for dimension in range(len(self.dimensions))]
+
+        data_order = [dimension for dimension in self.loop_order if dimension in self.data_dimensions]
+        case_order = [dimension for dimension in self.loop_order if dimension not in self.data_dimensions]
+        case_keys = [[query for query in self.plan_keys[3] if query != 0] if dimension == 3 else self.plan_keys[dimension] for dimension in case_order]
+
+        for data_values in product(*[self.plan_keys[dimension] for dimension in data_order]):
+            data = dict(zip(data_order, data_values))
+
+            if self.skip_durability(data[1], data[13]):
+                continue
+
+            # Import the data when it is not loaded yet, or when the import is one of the queries of the run
+            if (0 in self.plan_keys[3]) or (self.loaded.get(data[1]) != (data[0], data[2], data[9], data[13])):
+                yield tuple(data[dimension] if dimension in data else 0 if dimension == 3 else min(self.dimensions[dimension]) for dimension in range(len(self.dimensions)))
+
+            for values in product(*case_keys):
+
+                # Put the values back in the order of the dimensions
+                case = tuple(data[dimension] if dimension in data else values[case_order.index(dimension)] for dimension in range(len(self.dimensions)))
+
+                if not self.skip_case(case):
+                    yield case
+
+    def config_label(self, config):
+
+        if len(config) == 0:
+            return 'default'
+
+        return ', '.join('{}={}'.format(name, value) for name, value in config.items())
+
     def connect(self, postgres_settings, mongodb_settings):
         self.postgres_settings = postgres_settings
-        self.mongodb_settings = mongodb_settings
+        self.mongodb_settings = dict(mongodb_settings)
+
+        # The number of nodes of a sharded host is a string key in a JSON config
+        if 'sharded_hosts' in self.mongodb_settings:
+            self.mongodb_settings['sharded_hosts'] = {int(nodes): host for nodes, host in self.mongodb_settings['sharded_hosts'].items()}
 
         try:
             # Connect to mongoDB
             self.mongoclient = pymongo.MongoClient(self.mongodb_settings['host'])
             # Connect to database in mongoDB
             self.mongodb = self.mongoclient[self.mongodb_settings['database']]
+            self.mongodb_host = self.mongodb_settings['host']
+            self.mongodb_nodes = 1
         except:
             print('Connection to MongoDB failed')
         else:
@@ -112,23 +421,119 @@ class Experiment:
 
         return query_lst
 
+    def json_to_queries(self, path_queries, file_name):
+
+        file_location = os.path.join(path_queries, file_name)
+
+        # Each query is a dictionary with the collection, the method (find or aggregate) and its arguments
+        # Dates are written as {"$date": "2018-03-01"}
+        with open(file_location) as handle:
+            query_lst = json.load(handle, object_hook=parse_date)
+
+        return query_lst
+
     def prepare_databases(self, path_queries):
 
-        ## Prepare mongoDB
+        self.path_queries = path_queries
+        self.prepared_filters = dict(self.filters)
 
-        #Drop collections
-        for collection in self.mongodb.list_collection_names():
+        ## Load queries
+        self.query_strings[0][0] = self.txt_to_queries(path_queries, "sql_queries_arrest.txt")
+        self.query_strings[1][0] = self.txt_to_queries(path_queries, "sql_queries_movies.txt")
+        self.query_strings[0][1] = self.json_to_queries(path_queries, "mongodb_queries_arrest.json")
+        self.query_strings[1][1] = self.json_to_queries(path_queries, "mongodb_queries_movies.json")
+
+        ## Optimize queries
+        self.optimized_query_strings[0][0] = self.txt_to_queries(path_queries, "sql_queries_arrest_optimized.txt")
+        self.optimized_query_strings[1][0] = self.txt_to_queries(path_queries, "sql_queries_movies_optimized.txt")
+        for data_set in self.data_set:
+            self.optimized_query_strings[data_set][1] = [optimize_query(spec) for spec in self.query_strings[data_set][1]]
+
+        ## Precompute aggregates
+        for data_set in self.data_set:
+            self.precomputed_query_strings[data_set][0] = [None for query in self.query_strings[data_set][0]]
+            self.precomputed_query_strings[data_set][1] = [None for spec in self.query_strings[data_set][1]]
+
+            for query in self.precomputed_queries:
+                name = self.summary_name(data_set, query)
+                self.precomputed_query_strings[data_set][0][query-1] = 'SELECT * FROM ' + name
+                self.precomputed_query_strings[data_set][1][query-1] = {'collection': name, 'method': 'find', 'filter': {}}
+
+        ## Parameterize queries, empty entries are queries without predicates
+        self.parameterized_query_strings[0][0] = [query or None for query in self.txt_to_queries(path_queries, "sql_queries_arrest_parameterized.txt")]
+        self.parameterized_query_strings[1][0] = [query or None for query in self.txt_to_queries(path_queries, "sql_queries_movies_parameterized.txt")]
+        self.parameterized_query_strings[0][1] = self.json_to_queries(path_queries, "mongodb_queries_arrest_parameterized.json")
+        self.parameterized_query_strings[1][1] = self.json_to_queries(path_queries, "mongodb_queries_movies_parameterized.json")
+        with open(os.path.join(path_queries, "query_parameters.json")) as handle:
+            self.query_parameters = json.load(handle)
+
+        ## Translate the mongoDB queries into SQL on jsonb documents, queries without a translation are left out
+        if 2 in self.planned_keys(1, self.filters):
+            for data_set in self.data_set:
+                self.query_strings[data_set][2] = self.translate_queries(self.query_strings[data_set][1])
+                self.optimized_query_strings[data_set][2] = self.translate_queries(self.optimized_query_strings[data_set][1])
+                self.precomputed_query_strings[data_set][2] = [None for spec in self.query_strings[data_set][1]]
+                self.parameterized_query_strings[data_set][2] = self.translate_queries(self.parameterized_query_strings[data_set][1], parameterized=True)
+                self.jsonb_indexes[data_set] = lookup_indexes(self.query_strings[data_set][1] + self.parameterized_query_strings[data_set][1])
+
+        ## Build the search columns and text indexes only when text queries run, they slow down every import
+        self.text_search = any(query in self.text_queries for query in self.planned_keys(3, self.filters))
+        self.time_range = any(query in self.time_queries for query in self.planned_keys(3, self.filters))
+
+        ## Prepare mongoDB, unless the run leaves it out
+        if 1 in self.planned_keys(1, self.filters):
+
+            #Drop collections
+            self.loaded.pop(1, None)
+            for collection in self.mongodb.list_collection_names():
+                try:
+                    self.mongodb[collection].drop()
+                except:
+                    print('Drop of MongoDB collection {} failed'.format(collection))
+
+        ## Prepare postgres, unless the run leaves it out
+        if 0 in self.planned_keys(1, self.filters):
+            self.create_postgres_tables(self.nodes[0])
+
+        ## Prepare the schema of the jsonb tables, its tables are created on import
+        if 2 in self.planned_keys(1, self.filters):
+            self.loaded.pop(2, None)
             try:
-                self.mongodb[collection].drop()
+                self.postgres_cur.execute('CREATE SCHEMA IF NOT EXISTS ' + SCHEMA)
             except:
-                print('Drop of MongoDB collection {} failed'.format(collection))
+                print('Creation of Postgres schema {} failed'.format(SCHEMA))
+            self.postgres_con.commit()
+
+    def translate_queries(self, specs, parameterized=False):
+
+        query_lst = []
+        for spec in specs:
+            try:
+                query_lst.append(None if spec is None else translate_query(spec, parameterized))
+            except ValueError as error:
+                print('Translation of mongoDB query to jsonb failed: {}'.format(error))
+                query_lst.append(None)
+
+        return query_lst
 
-        ## Prepare postgres
+    def create_postgres_tables(self, nodes):
 
         # Read file with create table queries
-        query_lst = self.txt_to_queries(path_queries, "create_tables.txt")
+        query_lst = self.txt_to_queries(self.path_queries, "create_tables.txt")
 
-        # Drop tables
+        # The new tables are empty
+        self.loaded.pop(0, None)
+
+        # Drop summaries, they depend on the tables
+        for data_set in self.data_set:
+            for query in self.precomputed_queries:
+                try:
+                    self.postgres_cur.execute('DROP MATERIALIZED VIEW IF EXISTS ' + self.summary_name(data_set, query))
+                except:
+                    print('Drop of Postgres materialized view {} failed'.format(self.summary_name(data_set, query)))
+        self.postgres_con.commit()
+
+        # Drop tables, partitions are dropped with their table
         for query in query_lst:
             try:
                 self.postgres_cur.execute('DROP TABLE IF EXISTS ' + query.split()[2][:-1])
@@ -136,32 +541,287 @@ class Experiment:
                 print('Drop of Postgres table {} failed'.format(query.split()[2][:-1]))
         self.postgres_con.commit()
 
-        # Create tables
+        # Create tables, with one hash partition per node for the partitioned tables
         for query in query_lst:
+            table = query.split()[2][:-1]
+            try:
+                if (nodes > 1) & (table in self.partition_keys):
+                    self.postgres_cur.execute('{} PARTITION BY HASH ({})'.format(query.strip(), self.partition_keys[table]))
+                    for remainder in range(nodes):
+                        self.postgres_cur.execute('CREATE TABLE {}_p{} PARTITION OF {} FOR VALUES WITH (MODULUS {}, REMAINDER {})'.format(table, remainder, table, nodes, remainder))
+                else:
+                    self.postgres_cur.execute(query)
+            except:
+                print('Creation of Postgres table {} failed'.format(table))
+        self.postgres_con.commit()
+
+        # Copies of the tables with the typed columns and indexes of the optimized queries, the original queries keep the plain tables
+        if 'optimized' in self.query_variant.values():
+            self.create_optimized_tables(nodes)
+
+        # Add GIN indexes on the tsvector expressions of the text queries, the columns of the tables stay the same
+        if self.text_search:
+            for query in self.txt_to_queries(self.path_queries, "text_search_tables.txt"):
+                try:
+                    self.postgres_cur.execute(query)
+                    self.postgres_con.commit()
+                except:
+                    print('Text search setup of Postgres tables failed: {}'.format(query))
+                    self.postgres_con.rollback()
+
+        # Add the date indexes of the time-range queries with the planned index methods
+        if self.time_range:
+            for query in self.txt_to_queries(self.path_queries, "time_range_tables.txt"):
+                if query.split('USING ')[1].split()[0] not in self.time_index_methods:
+                    continue
+                try:
+                    self.postgres_cur.execute(query)
+                    self.postgres_con.commit()
+                except:
+                    print('Time range setup of Postgres tables failed: {}'.format(query))
+                    self.postgres_con.rollback()
+
+        # Create the summaries as materialized views, they are filled after each import
+        if 'precomputed' in self.query_variant.values():
+            for data_set in self.data_set:
+                for query in self.precomputed_queries:
+                    try:
+                        self.postgres_cur.execute('CREATE MATERIALIZED VIEW {} AS {} WITH NO DATA'.format(self.summary_name(data_set, query), self.query_strings[data_set][0][query-1].strip().rstrip(';')))
+                    except:
+                        print('Creation of Postgres materialized view {} failed'.format(self.summary_name(data_set, query)))
+            self.postgres_con.commit()
+
+        self.postgres_nodes = nodes
+
+    def create_optimized_tables(self, nodes):
+
+        # The tables that optimize_tables.txt changes get a copy in the optimized schema, with the same layout
+        statements = self.txt_to_queries(self.path_queries, "optimize_tables.txt")
+        self.optimized_tables = sorted(set(query.split(' ON ')[1].split()[0] if query.startswith('CREATE INDEX') else query.split()[2] for query in statements))
+
+        try:
+            self.postgres_cur.execute('CREATE SCHEMA IF NOT EXISTS ' + self.optimized_schema)
+        except:
+            print('Creation of Postgres schema {} failed'.format(self.optimized_schema))
+        self.postgres_con.commit()
+
+        for table in self.optimized_tables:
+            copy = '{}.{}'.format(self.optimized_schema, table)
             try:
+                self.postgres_cur.execute('DROP TABLE IF EXISTS ' + copy)
+                if (nodes > 1) & (table in self.partition_keys):
+                    self.postgres_cur.execute('CREATE TABLE {} (LIKE {} INCLUDING ALL) PARTITION BY HASH ({})'.format(copy, table, self.partition_keys[table]))
+                    for remainder in range(nodes):
+                        self.postgres_cur.execute('CREATE TABLE {}_p{} PARTITION OF {} FOR VALUES WITH (MODULUS {}, REMAINDER {})'.format(copy, remainder, copy, nodes, remainder))
+                else:
+                    self.postgres_cur.execute('CREATE TABLE {} (LIKE {} INCLUDING ALL)'.format(copy, table))
+                self.postgres_con.commit()
+            except:
+                print('Creation of Postgres table {} failed'.format(copy))
+                self.postgres_con.rollback()
+
+        # The statements name the tables without schema, they resolve to the copies
+        # Each statement is its own transaction, so a failed statement does not abort the ones after it
+        for query in statements:
+            try:
+                self.postgres_cur.execute('SET LOCAL search_path TO ' + self.optimized_schema)
                 self.postgres_cur.execute(query)
+                self.postgres_con.commit()
+            except:
+                print('Optimization of Postgres tables failed: {}'.format(query))
+                self.postgres_con.rollback()
+
+    def fill_optimized_tables(self, tables):
+
+        # Copy the imported data into the tables of the optimized queries, outside the timed import
+        start = time.time()
+        for table in self.optimized_tables:
+            if table not in tables:
+                continue
+            try:
+                self.postgres_cur.execute('TRUNCATE TABLE {}.{}'.format(self.optimized_schema, table))
+                self.postgres_cur.execute('INSERT INTO {}.{} SELECT * FROM {}'.format(self.optimized_schema, table, table))
             except:
-                print('Creation of Postgres table {} failed'.format(query.split()[2][:-1]))
+                print('\t Copy of {} table to schema {} failed'.format(table, self.optimized_schema))
+                self.postgres_con.rollback()
+            self.postgres_con.commit()
+
+        # Collect planner statistics for the indexes of the optimized queries
+        self.postgres_cur.execute('ANALYZE')
         self.postgres_con.commit()
 
-        ## Load queries
-        self.query_strings[0][0] = self.txt_to_queries(path_queries, "sql_queries_arrest.txt")
-        self.query_strings[1][0] = self.txt_to_queries(path_queries, "sql_queries_movies.txt")
+        print('\t \t Copied the data to the optimized tables in {} ms'.format((time.time()-start)*1000))
+
+    def use_mongodb_layout(self, nodes):
 
-    def log_response_time(self, case, response_time):
+        if nodes == self.mongodb_nodes:
+            return
+
+        if nodes == 1:
+            host = self.mongodb_settings['host']
+        elif nodes in self.mongodb_settings.get('sharded_hosts', {}):
+            host = self.mongodb_settings['sharded_hosts'][nodes]
+        else:
+            # Start a local cluster with one shard per node, it is reused for every data set
+            # Clusters of other layouts are stopped first, they would use the same ports
+            if nodes not in self.clusters:
+                for other in list(self.clusters):
+                    if other == self.mongodb_nodes:
+                        self.mongoclient.close()
+                    self.clusters.pop(other).stop()
+                self.clusters[nodes] = LocalShardedCluster(nodes, **self.mongodb_settings.get('local_cluster', {}))
+                self.clusters[nodes].start()
+            host = self.clusters[nodes].host
+
+        self.mongoclient = pymongo.MongoClient(host)
+        self.mongodb = self.mongoclient[self.mongodb_settings['database']]
+        self.mongodb_host = host
+        self.mongodb_nodes = nodes
+
+    def shard_collections(self, collections):
+
+        try:
+            self.mongoclient.admin.command('enableSharding', self.mongodb_settings['database'])
+        except:
+            print('\t Enabling sharding of {} failed'.format(self.mongodb_settings['database']))
+
+        for collection in collections:
+            if collection in self.shard_keys:
+                try:
+                    self.mongoclient.admin.command('shardCollection', '{}.{}'.format(self.mongodb_settings['database'], collection), key={self.shard_keys[collection]: 'hashed'})
+                except:
+                    print('\t Sharding of {} collection failed'.format(collection))
+
+    def stop_clusters(self):
+
+        # Return to the single server before its cluster goes away
+        if self.mongodb_nodes in self.clusters:
+            self.use_mongodb_layout(1)
+
+        for cluster in self.clusters.values():
+            cluster.stop()
+        self.clusters = {}
+
+    def log_response_time(self, case, response_time, status='ok', cache_hit=None, query=None, conversion_time=None, peak_memory=None, result_rows=None):
 
         new_row = {"person": self.person,
                    "data_set": self.data_set[case[0]],
                    "data_store": self.data_store[case[1]],
                    "data_size": self.data_size[case[2]][case[0]],
-                   "query": self.query[case[3]],
+                   "query": self.query[case[3]] if query is None else query,
                    "trial": self.trail[case[4]],
+                   "response_time": response_time,
+                   "status": status,
+                   "postgres_config": self.config_label(self.postgres_config[case[5]]) if case[1] != 1 else 'n/a',
+                   "mongodb_options": self.config_label(self.mongodb_options[case[6]]) if case[1] == 1 else 'n/a',
+                   "query_variant": self.query_variant[case[7]],
+                   "cache_mode": self.cache_mode[case[8]],
+                   "cache_hit": cache_hit,
+                   "nodes": self.nodes[case[9]],
+                   "materialization": self.materialization[case[10]],
+                   "conversion_time": conversion_time,
+                   "peak_memory": peak_memory,
+                   "concurrency": self.concurrency[case[11]],
+                   "selectivity": self.selectivity[case[12]],
+                   "result_rows": result_rows,
+                   "durability": self.config_label(self.durability[case[13]])}
+
+        self.results.append(new_row)
+
+    def log_import_phase(self, case, table, phase, response_time, size=None, rows=None):
+
+        new_row = {"person": self.person,
+                   "data_set": self.data_set[case[0]],
+                   "data_store": self.data_store[case[1]],
+                   "data_size": self.data_size[case[2]][case[0]],
+                   "nodes": self.nodes[case[9]],
+                   "durability": self.config_label(self.durability[case[13]]),
+                   "table": table,
+                   "phase": phase,
+                   "bytes": size,
+                   "rows": rows,
                    "response_time": response_time}
 
-        self.results = self.results.append(new_row, ignore_index=True)
+        self.import_results.append(new_row)
+
+    def log_import_with_indexes(self, case, response_time, index_time):
+
+        # With text queries the import is also logged with its index builds, of which the text indexes are a large part
+        # The import row itself leaves the index phases out, so it compares with the imports of runs without text queries
+        if self.text_search:
+            self.log_response_time(case, response_time + index_time, query='import + index')
+            print('\t \t Imported data with its index builds in {} ms'.format(response_time + index_time))
+
+    def print_import_phases(self, case):
+
+        # Split the import time of this case into client and server phases
+        phases = [row for row in self.import_results if (row['data_set'] == self.data_set[case[0]]) &
+                                                       (row['data_store'] == self.data_store[case[1]]) &
+                                                       (row['data_size'] == self.data_size[case[2]][case[0]]) &
+                                                       (row['nodes'] == self.nodes[case[9]]) &
+                                                       (row['durability'] == self.config_label(self.durability[case[13]]))]
+        client = sum(row['response_time'] for row in phases if row['phase'] in self.client_phases)
+        server = sum(row['response_time'] for row in phases if row['phase'] not in self.client_phases)
+        rows = sum(row['rows'] for row in phases if (row['phase'] == 'send_apply') & (row['rows'] is not None))
+        commit = sum(row['response_time'] for row in phases if row['phase'] == 'commit')
+
+        print('\t \t Import spent {} ms in the client and {} ms in the server'.format(client, server))
+        print('\t \t Import loaded {} rows per second with durability {}, commits took {} ms'.format(rows / (client+server) * 1000 if client+server > 0 else np.nan, self.config_label(self.durability[case[13]]), commit))
+
+    def set_postgres_persistence(self, table, unlogged):
+
+        # Partitioned tables have no storage, their partitions are changed instead
+        self.postgres_cur.execute('SELECT inhrelid::regclass::text FROM pg_inherits WHERE inhparent = %s::regclass', (table,))
+        relations = [row[0] for row in self.postgres_cur.fetchall()] or [table]
+
+        # Empty tables change persistence without rewriting data
+        for relation in relations:
+            self.postgres_cur.execute('ALTER TABLE {} SET {}'.format(relation, 'UNLOGGED' if unlogged else 'LOGGED'))
+
+    def set_postgres_durability(self, case, tables):
+
+        durability = self.durability[case[13]]
+
+        for table in tables:
+            try:
+                self.set_postgres_persistence(table, durability.get('unlogged', False))
+            except:
+                print('\t Change of persistence of {} table failed'.format(table))
+            self.postgres_con.commit()
+
+        # Commits of the import wait for the WAL flush, unless synchronous_commit is off, the setting lasts until reset
+        if 'synchronous_commit' in durability:
+            value = durability['synchronous_commit']
+            self.postgres_cur.execute("SELECT set_config('synchronous_commit', %s, false)", (('on' if value else 'off') if isinstance(value, bool) else str(value),))
+            self.postgres_con.commit()
+
+    def reset_postgres_durability(self):
+
+        self.postgres_cur.execute('RESET synchronous_commit')
+        self.postgres_con.commit()
+
+    def drop_postgres_indexes(self, table):
+
+        # Secondary indexes are dropped before the load and rebuilt after it, constraint indexes are kept
+        self.postgres_cur.execute("""
+        SELECT indexname, indexdef
+        FROM pg_indexes
+        WHERE schemaname = current_schema() AND tablename = %s
+        AND indexname NOT IN (SELECT conname FROM pg_constraint WHERE conrelid = %s::regclass)
+        """, (table, table))
+        indexes = self.postgres_cur.fetchall()
+
+        for indexname, indexdef in indexes:
+            self.postgres_cur.execute('DROP INDEX ' + indexname)
+
+        return [indexdef for indexname, indexdef in indexes]
 
     def update_postgres(self, case, path):
 
+        # Recreate the tables when the layout changes
+        if self.postgres_nodes != self.nodes[case[9]]:
+            self.create_postgres_tables(self.nodes[case[9]])
+
         # Drop data in datastore
         for filename in os.listdir(path):
             with open(os.path.join(path,filename), 'r') as file:
@@ -172,30 +832,79 @@ class Experiment:
             self.postgres_con.commit()
         print('\t All postgres tables dropped')
 
-        # Import data to datastore
+        # Apply the durability of the import to the empty tables and the session
+        self.set_postgres_durability(case, [filename.split('.')[0] for filename in os.listdir(path)])
+
+        # Import data to datastore, the import time covers the read, the load and the commit of each table
+        # The secondary indexes are dropped and rebuilt apart from it, their time is only in the index phase
         start = time.time()
+        excluded = 0
+        indexing = 0
         for filename in os.listdir(path):
-            with open(os.path.join(path,filename), 'r') as file:
-                try:
-                    self.postgres_cur.copy_expert(sql="""
-                    COPY {} FROM STDIN WITH
-                        CSV
-                        HEADER
-                        DELIMITER AS ','
-                    """.format(filename.split('.')[0]), file=file)
-                except:
-                    print('\t Import of {} table failed'.format(filename.split('.')[0]))
+            table = filename.split('.')[0]
+            try:
+                phase_start = time.time()
+                with open(os.path.join(path,filename), 'rb') as file:
+                    data = file.read()
+                self.log_import_phase(case, table, 'read', (time.time()-phase_start)*1000, len(data))
+
+                phase_start = time.time()
+                indexes = self.drop_postgres_indexes(table)
+                drop_time = (time.time()-phase_start)*1000
+
+                # Postgres parses the CSV in the server, so the transfer and the server side load are one phase
+                phase_start = time.time()
+                self.postgres_cur.copy_expert(sql="""
+                COPY {} FROM STDIN WITH
+                    CSV
+                    HEADER
+                    DELIMITER AS ','
+                """.format(table), file=io.BytesIO(data))
+                rows = self.postgres_cur.rowcount
+                self.log_import_phase(case, table, 'send_apply', (time.time()-phase_start)*1000, len(data), rows)
+
+                phase_start = time.time()
+                for indexdef in indexes:
+                    self.postgres_cur.execute(indexdef)
+                index_time = (time.time()-phase_start)*1000
+                self.log_import_phase(case, table, 'index', drop_time + index_time, len(data), rows)
+                excluded += drop_time + index_time
+                indexing += drop_time + index_time
+            except:
+                print('\t Import of {} table failed'.format(table))
+
+            phase_start = time.time()
             self.postgres_con.commit()
+            self.log_import_phase(case, table, 'commit', (time.time()-phase_start)*1000)
         end = time.time()
 
-        response_time = (end-start)*1000
+        response_time = (end-start)*1000 - excluded
 
+        self.reset_postgres_durability()
         self.log_response_time(case, response_time)
 
-        print('\t \t Imported data size {} to postgres in {} ms'.format(self.data_size[case[2]][case[1]], response_time))
+        print('\t \t Imported data size {} to postgres in {} ms'.format(self.data_size[case[2]][case[0]], response_time))
+        self.log_import_with_indexes(case, response_time, indexing)
+        self.print_import_phases(case)
+
+        if 'optimized' in self.query_variant.values():
+            self.fill_optimized_tables([filename.split('.')[0] for filename in os.listdir(path)])
 
     def update_mongodb(self, case, path):
 
+        # Write concern of the import, the server default when the durability has no mongoDB options
+        # An invalid combination, such as w 0 with j, fails the import and the queries on its data
+        durability = {name: value for name, value in self.durability[case[13]].items() if name in self.mongodb_durability}
+        try:
+            write_concern = WriteConcern(**durability) if len(durability) > 0 else None
+        except pymongo.errors.ConfigurationError as error:
+            print('\t Durability {} is not a valid write concern: {}'.format(self.config_label(self.durability[case[13]]), error))
+            self.log_response_time(case, np.nan, 'failed')
+            return False
+
+        # Switch to the server or cluster of the layout
+        self.use_mongodb_layout(self.nodes[case[9]])
+
         # Drop data in datastore
         for collection in self.mongodb.list_collection_names():
             try:
@@ -204,952 +913,1135 @@ class Experiment:
                 print('\t Drop of {} collection failed'.format(collection))
         print('\t All mongoDB tables dropped')
 
-        # Import data to datastore
+        # Shard the collections before the import
+        if self.nodes[case[9]] > 1:
+            self.shard_collections([filename.split('.')[0] for filename in os.listdir(path)])
+
+        # Import data to datastore, the import time covers the read, the parse, the inserts and the flush to disk
+        # The indexes are only in their own phase, as in postgres
         start = time.time()
+        excluded = 0
+        indexing = 0
+        date_sources = {}
         for filename in os.listdir(path):
-            with open(os.path.join(path,filename), 'r') as file:
-                try:
-                    file_data = json.load(file)
-                    col = self.mongodb[filename.split('.')[0]]
-                    if isinstance(file_data, list):
-                        col.insert_many(file_data)
-                    elif isinstance(file_data, dict):
-                        if len(file_data.keys())<20:
-                            col.insert_one(file_data)
-                        else:
-                            for key in file_data.keys():
-                                col.insert_one(file_data[key])
-                    else:
-                        print('Unknown file type')
-                except:
-                    print('\t Import of {} collection failed'.format(filename.split('.')[0]))
+            table = filename.split('.')[0]
+            try:
+                phase_start = time.time()
+                with open(os.path.join(path,filename), 'rb') as file:
+                    data = file.read()
+                self.log_import_phase(case, table, 'read', (time.time()-phase_start)*1000, len(data))
+
+                phase_start = time.time()
+                file_data = json.loads(data)
+                self.log_import_phase(case, table, 'parse', (time.time()-phase_start)*1000, len(data))
+
+                # Keep the documents for their copy with dates
+                if self.time_range and (table in self.date_collections):
+                    date_sources[table] = file_data
+
+                # Encode the documents to BSON in the client, the driver sends raw BSON documents as they are
+                phase_start = time.time()
+                if isinstance(file_data, list):
+                    documents = file_data
+                elif isinstance(file_data, dict):
+                    documents = [file_data] if len(file_data.keys())<20 else list(file_data.values())
+                else:
+                    print('Unknown file type')
+                    documents = []
+                documents = [RawBSONDocument(bson.encode(document)) for document in documents]
+                rows = len(documents)
+                self.log_import_phase(case, table, 'encode', (time.time()-phase_start)*1000, len(data), rows)
+
+                # With a write concern each insert waits for its acknowledgement, which is the commit of the write
+                phase_start = time.time()
+                col = self.mongodb[table].with_options(write_concern=write_concern)
+                if isinstance(file_data, list):
+                    col.insert_many(documents)
+                else:
+                    for document in documents:
+                        col.insert_one(document)
+                self.log_import_phase(case, table, 'send_apply', (time.time()-phase_start)*1000, len(data), rows)
+
+                # Unacknowledged writes may still be in flight, wait until the server applied them before the next phase
+                if (write_concern is not None) and (not write_concern.acknowledged):
+                    phase_start = time.time()
+                    self.wait_for_writes(table, rows)
+                    self.log_import_phase(case, table, 'wait', (time.time()-phase_start)*1000, len(data), rows)
+
+                phase_start = time.time()
+                if self.text_search and (table in self.text_indexes):
+                    col.create_index(self.text_indexes[table])
+                self.log_import_phase(case, table, 'index', (time.time()-phase_start)*1000, len(data), rows)
+                excluded += (time.time()-phase_start)*1000
+                indexing += (time.time()-phase_start)*1000
+            except:
+                print('\t Import of {} collection failed'.format(table))
+
+        # The copies with dates are not part of the import time
+        for table, file_data in date_sources.items():
+            excluded += self.import_date_collection(case, table, file_data, write_concern)
+
+        # Flush the writes to disk, with every write concern, so the commit phase measures the same work in each durability
+        # Like the commits of postgres, the flush is part of the import time
+        phase_start = time.time()
+        try:
+            self.mongoclient.admin.command('fsync')
+        except:
+            print('\t Fsync of mongoDB failed')
+        self.log_import_phase(case, 'all', 'commit', (time.time()-phase_start)*1000)
         end = time.time()
 
-        response_time = (end-start)*1000
+        response_time = (end-start)*1000 - excluded
 
         self.log_response_time(case, response_time)
 
-        print('\t \t Imported data size {} to mongoDB in {} ms'.format(self.data_size[case[2]][case[1]], response_time))
+        print('\t \t Imported data size {} to mongoDB in {} ms'.format(self.data_size[case[2]][case[0]], response_time))
+        self.log_import_with_indexes(case, response_time, indexing)
+        self.print_import_phases(case)
 
-    def update_databases(self, case):
+        return True
 
-        if (case[2] == 0): # data_size 0
-            print('--------------------------------------------------------------------------------------')
-            print('Start with experiment on {} data set in {} database'.format(self.data_set[case[0]],self.data_store[case[1]]))
+    def wait_for_writes(self, table, rows, timeout=60):
 
-        # Find and open path with new data
-        path = os.path.join(self.data_set[case[0]] + '_' + self.data_store[case[1]], self.data_size[case[2]][case[0]])
+        # Count the documents until all rows are there, unacknowledged writes give no other signal that they were applied
+        deadline = time.time() + timeout
+        while self.mongodb[table].count_documents({}) < rows:
+            if time.time() > deadline:
+                print('\t Writes to {} collection were not applied within {} s'.format(table, timeout))
+                return
+            time.sleep(0.01)
 
-        if case[1] == 0: # data_store 0 postgres
+    def convert_dates(self, file_data, fields):
 
-            self.update_postgres(case, path)
+        # The same shapes of files as in the import
+        if isinstance(file_data, list):
+            documents = file_data
+        elif len(file_data.keys())<20:
+            documents = [file_data]
+        else:
+            documents = list(file_data.values())
 
-        else: # data_store 1 mongodb
+        # Copies of the documents with the date fields as dates, the documents themselves are left as they are
+        converted = []
+        for document in documents:
+            document = dict(document)
+            for field, date_format in fields.items():
+                if isinstance(document.get(field), str):
+                    try:
+                        document[field] = datetime.datetime.strptime(document[field], date_format)
+                    except ValueError:
+                        document[field] = None
+            converted.append(document)
 
-            self.update_mongodb(case, path)
+        return converted
 
-    def run_postgres_query(self, case):
+    def import_date_collection(self, case, table, file_data, write_concern):
 
+        # Fill the copy of a collection for the time-range queries, with the same layout and write concern, and return its time in ms
         start = time.time()
+        collection, fields = self.date_collections[table]
         try:
-            self.postgres_cur.execute(self.query_strings[case[0]][case[1]][case[3]-1])
-            self.postgres_cur.fetchall()
+            if self.nodes[case[9]] > 1:
+                self.shard_collections([collection])
+
+            phase_start = time.time()
+            documents = self.convert_dates(file_data, fields)
+            self.log_import_phase(case, collection, 'convert', (time.time()-phase_start)*1000, None, len(documents))
+
+            phase_start = time.time()
+            documents = [RawBSONDocument(bson.encode(document)) for document in documents]
+            self.log_import_phase(case, collection, 'encode', (time.time()-phase_start)*1000, None, len(documents))
+
+            phase_start = time.time()
+            col = self.mongodb[collection].with_options(write_concern=write_concern)
+            col.insert_many(documents)
+            if (write_concern is not None) and (not write_concern.acknowledged):
+                self.wait_for_writes(collection, len(documents))
+            self.log_import_phase(case, collection, 'copy', (time.time()-phase_start)*1000, None, len(documents))
+
+            phase_start = time.time()
+            for keys in self.date_indexes.get(collection, []):
+                col.create_index(keys)
+            self.log_import_phase(case, collection, 'index', (time.time()-phase_start)*1000, None, len(documents))
         except:
-            print('\t Query failed')
-        end = time.time()
+            print('\t Import of {} collection failed'.format(collection))
 
-        response_time = (end-start)*1000
+        return (time.time()-start)*1000
 
-        # Log response time
-        self.log_response_time(case, response_time)
-
-        # Cache the response time
-        self.cache.append(response_time)
+    def create_jsonb_tables(self, collections, nodes, unlogged=False):
 
-    def run_mongodb_query_arrest(self, case):
-
-        if case[3] == 1:
-            start = time.time()
+        # One jsonb document per row, with one hash partition per node for the collections with a shard key
+        # Only the partitions are unlogged, a partitioned table has no storage of its own
+        persistence = 'UNLOGGED ' if unlogged else ''
+        for collection in collections:
+            table = table_name(collection)
             try:
-                mycol = self.mongodb["arrest_info"]
-                mydoc = mycol.find(
-                    {
-                        '$or': [
-                            {'PD_DESC': { '$eq': "ASSAULT 3" }},
-                            {'PD_DESC': { '$eq': "RAPE 3"}},
-                            {'PD_DESC': { '$eq': "RAPE 2"}},
-                            {'PD_DESC': { '$eq': "RAPE 1"}},
-                            {'PD_DESC': { '$eq': "OBSCENITY 1 "}}
-                            ]
-                        }
-                    )
-                temp = [i for i in mydoc] # Equivalent to fetchall for postgres
+                self.postgres_cur.execute('DROP TABLE IF EXISTS ' + table)
+                if (nodes > 1) & (collection in self.shard_keys):
+                    self.postgres_cur.execute('CREATE TABLE {} (doc jsonb NOT NULL) PARTITION BY HASH ((doc->>{}))'.format(table, quote_literal(self.shard_keys[collection])))
+                    for remainder in range(nodes):
+                        self.postgres_cur.execute('CREATE {}TABLE {}_p{} PARTITION OF {} FOR VALUES WITH (MODULUS {}, REMAINDER {})'.format(persistence, table, remainder, table, nodes, remainder))
+                else:
+                    self.postgres_cur.execute('CREATE {}TABLE {} (doc jsonb NOT NULL)'.format(persistence, table))
+                self.postgres_con.commit()
             except:
-                print('\t Query failed')
-            end = time.time()
+                print('\t Creation of jsonb table {} failed'.format(table))
+                self.postgres_con.rollback()
 
-        elif case[3] == 2:
-            start = time.time()
-            try:
-                mycol = self.mongodb["arrest_info"]
-                mydoc = mycol.find({ }, { 'ARREST_PRECINCT':1, 'ARREST_DATE':1 , 'PD_CD':1, 'PD_DESC':1, 'KY_CD':1 }).sort([( '$natural', 1 )] )
-                temp = [i for i in mydoc] # Equivalent to fetchall for postgres
-            except:
-                print('\t Query failed')
-            end = time.time()
+    def update_jsonb(self, case, path):
 
-        elif case[3] == 3:
-            start = time.time()
-            try:
-                mycol = self.mongodb["arrest_info"]
-                mydoc = mycol.find(
-                    {
-                        '$or': [
-                            {'PD_DESC': { '$eq': "ASSAULT 3" }},
-                            {'PD_DESC': { '$eq': "RAPE 3"}},
-                            {'PD_DESC': { '$eq': "RAPE 2"}},
-                            {'PD_DESC': { '$eq': "RAPE 1"}},
-                            {'PD_DESC': { '$eq': "OBSCENITY 1 "}}
-                            ]
-                        },
-                    # The SELECT PART
-                    {  'ARREST_PRECINCT':1, 'ARREST_DATE':1 , 'PD_CD':1, 'PD_DESC':1, 'KY_CD':1  }
-                ).sort([( '$natural', 1 )] )
-                temp = [i for i in mydoc] # Equivalent to fetchall for postgres
-            except:
-                print('\t Query failed')
-            end = time.time()
+        # Drop data in datastore
+        self.create_jsonb_tables([filename.split('.')[0] for filename in os.listdir(path)], self.nodes[case[9]], self.durability[case[13]].get('unlogged', False))
+        print('\t All jsonb tables dropped')
 
-        elif case[3] == 4:
-            start = time.time()
-            try:
-                mycol = self.mongodb["arrest_info"]
-                mydoc = mycol.aggregate([
-                    {
-                        '$lookup':{
-                            'from': "arrest_person",
-                            'localField': "ARREST_KEY",
-                            'foreignField': "ARREST_KEY",
-                            'as': "person"
-                            }
-                        },
-                    {
-                        '$unwind': {
-                            'path': "$person",
-                            'preserveNullAndEmptyArrays': False
-                            }
-                        },
-                    {
-                        '$match': {
-                            "$and": [
-                            {'LAW_CAT_CD': { '$eq': "F" }},
-                            {'person.PERP_SEX': { '$eq': "M"}}
-                                ]
-                            }
-                        }
-                    ], maxTimeMS = 2000)
-                temp = [i for i in mydoc] # Equivalent to fetchall for postgres
-            except pymongo.errors.ExecutionTimeout:
-                print('\t \t \t Time limit exceeded')
-            except:
-                print('\t Query failed')
-            end = time.time()
+        # The tables are created with their persistence, only the session needs its durability
+        self.set_postgres_durability(case, [])
 
-        elif case[3] == 5:
-            start = time.time()
+        # Import data to datastore, the files are parsed in the client as for mongoDB
+        # As in postgres, the index phase is left out of the import time
+        start = time.time()
+        excluded = 0
+        indexing = 0
+        for filename in os.listdir(path):
+            table = filename.split('.')[0]
             try:
-                mycol = self.mongodb["arrest_info"]
-                mydoc = mycol.aggregate([
-                    {
-                        '$lookup':{
-                            'from': "arrest_person",
-                            'localField': "ARREST_KEY",
-                            'foreignField': "ARREST_KEY",
-                            'as': "person"
-                            }
-                        },
-                    {
-                        '$unwind': {
-                            'path': "$person",
-                            'preserveNullAndEmptyArrays': False
-                            }
-                        },
-                    {
-                        # These can be alter to change the number of returned values
-                         '$project':{
-                            'ARREST_PRECINCT' : 1,
-                            'ARREST_DATE' : 1,
-                            'PD_CD': 1,
-                            'PERP_RACE' : '$person.PERP_RACE',
-                            'PERP_SEX' : "$person.PERP_SEX",
-                            'AGE_GROUP' : "$person.AGE_GROUP"
-                            }
-                        }
-                    ], maxTimeMS = 2000
-                )
-                temp = [i for i in mydoc] # Equivalent to fetchall for postgres
-            except pymongo.errors.ExecutionTimeout:
-                print('\t \t \t Time limit exceeded')
+                phase_start = time.time()
+                with open(os.path.join(path,filename), 'rb') as file:
+                    data = file.read()
+                self.log_import_phase(case, table, 'read', (time.time()-phase_start)*1000, len(data))
+
+                phase_start = time.time()
+                file_data = json.loads(data)
+                self.log_import_phase(case, table, 'parse', (time.time()-phase_start)*1000, len(data))
+
+                # One document per line in the text COPY format, which needs its backslashes escaped, serialized in the client
+                phase_start = time.time()
+                if isinstance(file_data, list):
+                    documents = file_data
+                elif isinstance(file_data, dict):
+                    documents = [file_data] if len(file_data.keys())<20 else list(file_data.values())
+                else:
+                    print('Unknown file type')
+                    documents = []
+                lines = '\n'.join(json.dumps(document).replace('\\', '\\\\') for document in documents).encode('utf-8')
+                self.log_import_phase(case, table, 'encode', (time.time()-phase_start)*1000, len(data), len(documents))
+
+                phase_start = time.time()
+                self.postgres_cur.copy_expert('COPY {} (doc) FROM STDIN'.format(table_name(table)), io.BytesIO(lines))
+                self.log_import_phase(case, table, 'send_apply', (time.time()-phase_start)*1000, len(data), len(documents))
+
+                # A GIN index answers the containment predicates, expression indexes the joins
+                phase_start = time.time()
+                self.postgres_cur.execute('CREATE INDEX ON {} USING gin (doc jsonb_path_ops)'.format(table_name(table)))
+                for field in self.jsonb_indexes.get(case[0], {}).get(table, []):
+                    self.postgres_cur.execute('CREATE INDEX ON {} ((doc->{}))'.format(table_name(table), quote_literal(field)))
+                self.log_import_phase(case, table, 'index', (time.time()-phase_start)*1000, len(data), len(documents))
+                excluded += (time.time()-phase_start)*1000
+                indexing += (time.time()-phase_start)*1000
             except:
-                print('\t Query failed')
-            end = time.time()
+                print('\t Import of {} jsonb table failed'.format(table))
+                self.postgres_con.rollback()
 
-        elif case[3] == 6:
-            start = time.time()
-            try:
-                mycol = self.mongodb["arrest_info"]
-                mydoc = mycol.aggregate([
-                    {
-                        '$lookup':{
-                            'from': "arrest_person",
-                            'localField': "ARREST_KEY",
-                            'foreignField': "ARREST_KEY",
-                            'as': "person"
-                            }
-                        },
-                    {
-                        '$unwind': {
-                            'path': "$person",
-                            'preserveNullAndEmptyArrays': False
-                            }
-                        },
-                    {
-                        '$match': {
-                            "$and": [
-                            {'LAW_CAT_CD': { '$eq': "F" }},
-                            {'person.PERP_SEX': { '$eq': "M"}}
-                                ]
-                            }
-                        },
-                    {
-                        # These can be alter to change the number of returned values
-                         '$project':{
-                            'ARREST_PRECINCT' : 1,
-                            'ARREST_DATE' : 1,
-                            'PD_CD': 1,
-                            'PERP_RACE' : '$person.PERP_RACE',
-                            'PERP_SEX' : "$person.PERP_SEX",
-                            'AGE_GROUP' : "$person.AGE_GROUP"
-                            }
-                        }
-                    ], maxTimeMS = 2000)
-                temp = [i for i in mydoc] # Equivalent to fetchall for postgres
-            except pymongo.errors.ExecutionTimeout:
-                print('\t \t \t Time limit exceeded')
-            except:
-                print('\t Query failed')
-            end = time.time()
+            phase_start = time.time()
+            self.postgres_con.commit()
+            self.log_import_phase(case, table, 'commit', (time.time()-phase_start)*1000)
+        end = time.time()
 
-        elif case[3] == 7:
-            start = time.time()
-            try:
-                mycol = self.mongodb["arrest_info"]
-                mydoc = mycol.aggregate([
-                    {
-                        '$lookup':{
-                            'from': "arrest_person",
-                            'localField': "ARREST_KEY",
-                            'foreignField': "ARREST_KEY",
-                            'as': "person"
-                            }
-                        },
-                    {
-                        '$unwind': {
-                            'path': "$person",
-                            'preserveNullAndEmptyArrays': False
-                            }
-                        },
-                    {
-                        '$lookup':{
-                            'from': "arrest_location",
-                            'localField': "ARREST_KEY",
-                            'foreignField': "ARREST_KEY",
-                            'as': "location"
-                            }
-                        },
-                    {
-                        '$unwind': {
-                            'path': "$location",
-                            'preserveNullAndEmptyArrays': False
-                            }
-                        },
-                    {
-                        '$match': {
-                            "$and": [
-                            {'LAW_CAT_CD': { '$eq': "F" }},
-                            {'person.PERP_SEX': { '$eq': "M"}},
-                            {'location.ARREST_BORO': { '$eq': "B"}}
-                                ]
-                            }
-                        }
-                    ], maxTimeMS = 2000)
-                temp = [i for i in mydoc] # Equivalent to fetchall for postgres
-            except pymongo.errors.ExecutionTimeout:
-                print('\t \t \t Time limit exceeded')
-            except:
-                print('\t Query failed')
-            end = time.time()
+        response_time = (end-start)*1000 - excluded
 
-        elif case[3] == 8:
-            start = time.time()
-            try:
-                mycol = self.mongodb["arrest_info"]
-                mydoc = mycol.aggregate([
-                    {
-                        '$lookup':{
-                            'from': "arrest_person",
-                            'localField': "ARREST_KEY",
-                            'foreignField': "ARREST_KEY",
-                            'as': "person"
-                            }
-                        },
-                    {
-                        '$unwind': {
-                            'path': "$person",
-                            'preserveNullAndEmptyArrays': False
-                            }
-                        },
-                    {
-                        '$lookup':{
-                            'from': "arrest_location",
-                            'localField': "ARREST_KEY",
-                            'foreignField': "ARREST_KEY",
-                            'as': "location"
-                            }
-                        },
-                    {
-                        '$unwind': {
-                            'path': "$location",
-                            'preserveNullAndEmptyArrays': False
-                            }
-                        },
-                       {
-                        # These can be alter to change the number of returned values
-                         '$project':{
-                            'ARREST_PRECINCT' : 1,
-                            'ARREST_DATE' : 1,
-                            'PD_CD': 1,
-                            'PERP_RACE' : '$person.PERP_RACE',
-                            'PERP_SEX' : "$person.PERP_SEX",
-                            'AGE_GROUP' : "$person.AGE_GROUP",
-                            'BOROUGH': "$location.ARREST_BORO",
-                            'X-COORDINATE': "$location.X_COORD_CD",
-                            'Y-COORDINATE': "$location.Y_COORD_CD"
-                            }
-                        }
-                    ], maxTimeMS = 2000)
-                temp = [i for i in mydoc] # Equivalent to fetchall for postgres
-            except pymongo.errors.ExecutionTimeout:
-                print('\t \t \t Time limit exceeded')
-            except:
-                print('\t Query failed')
-            end = time.time()
+        self.reset_postgres_durability()
+        self.log_response_time(case, response_time)
 
-        elif case[3] == 9:
-            start = time.time()
-            try:
-                mycol = self.mongodb["arrest_info"]
-                mydoc = mycol.aggregate([
-                    {
-                        '$lookup':{
-                            'from': "arrest_person",
-                            'localField': "ARREST_KEY",
-                            'foreignField': "ARREST_KEY",
-                            'as': "person"
-                            }
-                        },
-                    {
-                        '$unwind': {
-                            'path': "$person",
-                            'preserveNullAndEmptyArrays': False
-                            }
-                        },
-                    {
-                        '$lookup':{
-                            'from': "arrest_location",
-                            'localField': "ARREST_KEY",
-                            'foreignField': "ARREST_KEY",
-                            'as': "location"
-                            }
-                        },
-                    {
-                        '$unwind': {
-                            'path': "$location",
-                            'preserveNullAndEmptyArrays': False
-                            }
-                        },
-                    {
-                        '$match': {
-                            "$and": [
-                            {'LAW_CAT_CD': { '$eq': "F" }},
-                            {'person.PERP_SEX': { '$eq': "M"}},
-                            {'location.ARREST_BORO': { '$eq': "B"}}
-                                ]
-                            }
-                        },
-                    {
-                        # These can be alter to change the number of returned values
-                         '$project':{
-                            'ARREST_PRECINCT' : 1,
-                            'ARREST_DATE' : 1,
-                            'PD_CD': 1,
-                            'PERP_RACE' : '$person.PERP_RACE',
-                            'PERP_SEX' : "$person.PERP_SEX",
-                            'AGE_GROUP' : "$person.AGE_GROUP",
-                            'BOROUGH': "$location.ARREST_BORO",
-                            'X-COORDINATE': "$location.X_COORD_CD",
-                            'Y-COORDINATE': "$location.Y_COORD_CD"
-                            }
-                        }
-                    ], maxTimeMS = 2000)
-                temp = [i for i in mydoc] # Equivalent to fetchall for postgres
-            except pymongo.errors.ExecutionTimeout:
-                print('\t \t \t Time limit exceeded')
-            except:
-                print('\t Query failed')
-            end = time.time()
+        print('\t \t Imported data size {} to jsonb in {} ms'.format(self.data_size[case[2]][case[0]], response_time))
+        self.log_import_with_indexes(case, response_time, indexing)
+        self.print_import_phases(case)
+
+        # Collect planner statistics of the documents, the expression indexes have none otherwise
+        for filename in os.listdir(path):
+            self.postgres_cur.execute('ANALYZE ' + table_name(filename.split('.')[0]))
+        self.postgres_con.commit()
+
+    def update_databases(self, case):
+
+        # Cached results are invalid once the data changes
+        self.result_cache.clear()
+
+        if (case[2] == self.plan_keys[2][0]): # first data_size of the run
+            print('--------------------------------------------------------------------------------------')
+            print('Start with experiment on {} data set in {} database on {} nodes'.format(self.data_set[case[0]],self.data_store[case[1]],self.nodes[case[9]]))
+
+        # Find and open path with new data
+        path = os.path.join(self.path_data, self.data_set[case[0]] + '_' + self.data_model[case[1]], self.data_size[case[2]][case[0]])
+
+        if case[1] == 0: # data_store 0 postgres
+
+            self.update_postgres(case, path)
+
+        elif case[1] == 1: # data_store 1 mongodb
+
+            if not self.update_mongodb(case, path):
+                # The data is not loaded, the queries on it are logged as failed
+                self.loaded.pop(case[1], None)
+                return
+
+        else: # data_store 2 jsonb in postgres
+
+            self.update_jsonb(case, path)
+
+        # The jsonb store has no summaries
+        if ('precomputed' in self.query_variant.values()) & (case[1] != 2):
+
+            self.refresh_summaries(case)
+
+        if 'parameterized' in self.query_variant.values():
+
+            self.sample_value_pools(case)
+
+        self.loaded[case[1]] = (case[0], case[2], case[9], case[13])
+
+    def summary_name(self, data_set, query):
+        return 'summary_{}_{}'.format(self.data_set[data_set], query)
+
+    def refresh_summaries(self, case):
+
+        # Log the refresh under the precomputed variant of the aggregate query
+        variant = [key for key, value in self.query_variant.items() if value == 'precomputed'][0]
+
+        for query in self.precomputed_queries:
+
+            name = self.summary_name(case[0], query)
 
-        elif case[3] == 10:
             start = time.time()
             try:
-                mycol = self.mongodb["arrest_info"]
-                mydoc = mycol.aggregate([
-                        {
-                        '$match': {
-                            'OFNS_DESC': {
-                              '$eq': "ROBBERY"
-                                }
-                            }
-                        },
-                    {
-                        "$group" : {
-                            '_id':"$ARREST_PRECINCT", 'count':{'$sum':1}}}
-                ], maxTimeMS = 2000)
-                temp = [i for i in mydoc] # Equivalent to fetchall for postgres
-            except pymongo.errors.ExecutionTimeout:
-                print('\t \t \t Time limit exceeded')
+                if case[1] == 0: # data_store 0 postgres
+                    self.postgres_cur.execute('REFRESH MATERIALIZED VIEW ' + name)
+                    self.postgres_con.commit()
+                else: # data_store 1 mongodb
+                    spec = self.query_strings[case[0]][case[1]][query-1]
+                    mycol = self.mongodb[spec['collection']]
+                    temp = [i for i in mycol.aggregate(spec['pipeline'] + [{'$out': name}])]
+                status = 'ok'
             except:
-                print('\t Query failed')
+                print('\t Refresh of summary {} failed'.format(name))
+                self.postgres_con.rollback()
+                status = 'failed'
             end = time.time()
 
-        elif case[3] == 11:
-            start = time.time()
+            response_time = (end-start)*1000 if status == 'ok' else np.nan
+
+            refresh_case = case[:3] + (query,) + case[4:7] + (variant,) + case[8:]
+            self.log_response_time(refresh_case, response_time, status, query='refresh ' + self.query[query])
+
+            print('\t \t Refreshed summary of query {} in {} ms'.format(self.query[query], response_time))
+
+    def sample_value_pools(self, case):
+
+        # Count the rows per distinct value of each parameter, outside the timing of the import
+        pools = {}
+        for name, parameter in self.query_parameters.get(self.data_set[case[0]], {}).items():
+            table, column = parameter[self.data_model[case[1]]]
             try:
-                mycol = self.mongodb["arrest_info"]
-                mydoc = mycol.aggregate([
-                    {
-                        '$lookup':{
-                            'from': "arrest_person",
-                            'localField': "ARREST_KEY",
-                            'foreignField': "ARREST_KEY",
-                            'as': "person"
-                            }
-                        },
-                    {
-                        '$unwind': {
-                            'path': "$person",
-                            'preserveNullAndEmptyArrays': False
-                            }
-                        },
-                    {
-                        '$match': {
-                            "$and": [
-                            {'OFNS_DESC': { '$eq': "ROBBERY" }},
-                            {'person.PERP_SEX': { '$eq': "M"}}
-                                ]
-                            }
-                        },
-                    {
-                        "$group" : {
-                            '_id':"$ARREST_PRECINCT", 'count':{'$sum':1}}
-                    }
-                    ], maxTimeMS = 2000)
-                temp = [i for i in mydoc] # Equivalent to fetchall for postgres
-            except pymongo.errors.ExecutionTimeout:
-                print('\t \t \t Time limit exceeded')
+                if case[1] == 0: # data_store 0 postgres
+                    self.postgres_cur.execute('SELECT {0}, count(*) FROM {1} WHERE {0} IS NOT NULL GROUP BY {0}'.format(column, table))
+                    rows = self.postgres_cur.fetchall()
+                    self.postgres_con.commit()
+                elif case[1] == 2: # data_store 2 jsonb in postgres
+                    self.postgres_cur.execute("SELECT doc->{0}, count(*) FROM {1} WHERE doc->{0} <> 'null' GROUP BY 1".format(quote_literal(column), table_name(table)))
+                    rows = self.postgres_cur.fetchall()
+                    self.postgres_con.commit()
+                else: # data_store 1 mongodb
+                    rows = [(row['_id'], row['count']) for row in self.mongodb[table].aggregate([{'$match': {column: {'$ne': None}}},
+                                                                                                  {'$group': {'_id': '$' + column, 'count': {'$sum': 1}}}])]
             except:
-                print('\t Query failed')
-            end = time.time()
+                print('\t Sampling of the values of parameter {} failed'.format(name))
+                self.postgres_con.rollback()
+                continue
+
+            # Sorted the same way in both stores, so a trial draws the same values from the same data
+            rows = sorted(rows, key=lambda row: str(row[0]))
+            if len(rows) > 0:
+                pools[name] = ([row[0] for row in rows], [row[1] for row in rows], parameter.get('contiguous', False))
+
+        self.value_pools[case[1]] = pools
+
+        print('\t \t Sampled the values of {} query parameters'.format(len(pools)))
+
+    def bind_query(self, case):
+
+        # Fill the parameters of the query with values drawn for this trial, queries without parameters are returned as is
+        query = self.get_query_strings(case)[case[3]-1]
+        names = find_parameters(query)
+        self.trial_values = {}
+        if len(names) == 0:
+            return query
+
+        # Each parameter selects a share of its rows so that, for independent predicates, the query selects the target fraction
+        fraction = self.selectivity[case[12]]
+        if fraction is not None:
+            fraction = fraction ** (1/len(names))
+
+        # The generator does not depend on the data store, so both stores run a trial with the same values
+        rng = np.random.default_rng([self.parameter_seed, case[0], case[2], case[3], case[4], case[12]])
+        pools = self.value_pools[case[1]]
+        for name in names:
+            values, counts, contiguous = pools[name]
+            self.trial_values[name] = tuple(choose_values(values, counts, fraction, rng, contiguous))
+
+        if case[1] == 0: # data_store 0 postgres
+            return self.postgres_cur.mogrify(query, self.trial_values).decode()
+
+        if case[1] == 2: # data_store 2 jsonb in postgres, the values are compared as jsonb
+            return self.postgres_cur.mogrify(query, {name: tuple(Json(value) for value in values) for name, values in self.trial_values.items()}).decode()
+
+        return bind_parameters(query, self.trial_values)
+
+    def get_query_strings(self, case):
+
+        if self.query_variant[case[7]] == 'optimized':
+            return self.optimized_query_strings[case[0]][case[1]]
+
+        if self.query_variant[case[7]] == 'precomputed':
+            return self.precomputed_query_strings[case[0]][case[1]]
+
+        if self.query_variant[case[7]] == 'parameterized':
+            return self.parameterized_query_strings[case[0]][case[1]]
+
+        return self.query_strings[case[0]][case[1]]
+
+    def has_query(self, case):
+
+        query_strings = self.get_query_strings(case)
+
+        return (0 < case[3] <= len(query_strings)) and (query_strings[case[3]-1] is not None)
+
+    def query_key(self, case):
+
+        # Identifies a query independent of data_size and trial
+        return (case[0], case[1], case[3]) + case[5:]
+
+    def histogram_key(self, case):
+
+        # Identifies a query at a data size independent of the trial
+        return case[:4] + case[5:]
+
+    def result_key(self, case):
 
+        # Identifies a query result independent of the trial and cache mode, results of parameterized queries also by their values
+        return case[:4] + case[5:8] + case[9:] + tuple(sorted(self.trial_values.items()))
+
+    def start_trial(self):
+
+        self.conversion_time = None
+        self.result_rows = None
+
+        if self.trace_memory:
+            tracemalloc.start()
+
+    def stop_trial(self):
+
+        if not self.trace_memory:
+            return None
+
+        peak_memory = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        return peak_memory
+
+    def read_through(self, case, fetch):
+
+        if self.cache_mode[case[8]] != 'cached':
+            return fetch(), None
+
+        result = self.result_cache.get(self.result_key(case))
+        if result is not None:
+            return result, True
+
+        result = fetch()
+        self.result_cache.put(self.result_key(case), result)
+
+        return result, False
+
+    def read_result(self, case, fetch):
+        from _materialize import count_rows
+
+        if self.profiler is not None:
+            result, cache_hit = self.profiler.run(lambda: self.read_through(case, fetch))
         else:
-            print('\t No query defined')
+            result, cache_hit = self.read_through(case, fetch)
+        self.result_rows = count_rows(result)
 
-        response_time = (end-start)*1000
+        return cache_hit
 
-        return response_time
+    def log_trial(self, case, response_time, status, cache_hit=None, peak_memory=None):
 
-    def run_mongodb_query_movies(self, case):
+        if status == 'ok':
+            # Record the response time
+            self.histograms.setdefault(self.histogram_key(case), LatencyHistogram()).record(response_time)
+        else:
+            # Censor the response time, the elapsed time of an unfinished query is not a latency
+            response_time = np.nan
 
-        if case[3] == 1:
-            start = time.time()
-            try:
-                mycol = self.mongodb["movies_info"]
-                mydoc = mycol.find(
-                    {
-                        '$or': [
-                            {'year': { '$eq': 1950}},
-                            {'year': { '$eq': 1951}},
-                            {'year': { '$eq': 1952}},
-                            {'year': { '$eq': 1953}},
-                            {'year': { '$eq': 1954}}
-                            ]
-                        }
-                    )
-                temp = [i for i in mydoc] # Equivalent to fetchall for postgres
-            except:
-                print('\t Query failed')
-            end = time.time()
+        if status == 'timed out':
+            self.timed_out.setdefault(self.query_key(case), case[2])
 
-        elif case[3] == 2:
-            start = time.time()
-            try:
-                mycol = self.mongodb["movies_info"]
-                mydoc = mycol.find({ }, { 'title':1, 'fullplot':1, 'year':1 , 'type':1, 'rated':1 })
-                temp = [i for i in mydoc] # Equivalent to fetchall for postgres
-            except:
-                print('\t Query failed')
-            end = time.time()
+        if cache_hit is not None:
+            self.cache_hits.append(cache_hit)
 
-        elif case[3] == 3:
-            start = time.time()
-            try:
-                mycol = self.mongodb["movies_info"]
-                mydoc = mycol.find(
-                    {
-                        '$or': [
-                            {'year': { '$eq': 1950}},
-                            {'year': { '$eq': 1951}},
-                            {'year': { '$eq': 1952}},
-                            {'year': { '$eq': 1953}},
-                            {'year': { '$eq': 1954}}
-                            ]
-                        },
-                    # The SELECT PART
-                    { 'title':1, 'fullplot':1, 'year':1 , 'type':1, 'rated':1}
-                )
-                temp = [i for i in mydoc] # Equivalent to fetchall for postgres
-            except:
-                print('\t Query failed')
-            end = time.time()
+        # Log response time
+        self.log_response_time(case, response_time, status, cache_hit, conversion_time=self.conversion_time, peak_memory=peak_memory, result_rows=self.result_rows)
 
-        elif case[3] == 4:
-            start = time.time()
-            try:
-                mycol = self.mongodb["all_comments"]
-                mydoc = mycol.aggregate([
-                    {
-                        '$lookup':{
-                            'from': "movies",
-                            'localField': "movie_id",
-                            'foreignField': "_id",
-                            'as': "movie"
-                            }
-                        },
-                    {
-                        '$unwind': {
-                            'path': "$movie",
-                            'preserveNullAndEmptyArrays': False
-                            }
-                        },
-                    {
-                        '$match': {
-                            '$or': [
-                                {'movie.year': { '$eq': 1950}},
-                                {'movie.year': { '$eq': 1951}},
-                                {'movie.year': { '$eq': 1952}},
-                                {'movie.year': { '$eq': 1953}},
-                                {'movie.year': { '$eq': 1954}}
-                                ]
-                            }
-                        }
-                    ])
-                temp = [i for i in mydoc] # Equivalent to fetchall for postgres
-            except:
-                print('\t Query failed')
-            end = time.time()
+    def postgres_trial_settings(self, case):
 
-        elif case[3] == 5:
-            start = time.time()
-            try:
-                mycol = self.mongodb["all_comments"]
-                mydoc = mycol.aggregate([
-                    {
-                        '$lookup':{
-                            'from': "movies",
-                            'localField': "movie_id",
-                            'foreignField': "_id",
-                            'as': "movie"
-                            }
-                        },
-                    {
-                        '$unwind': {
-                            'path': "$movie",
-                            'preserveNullAndEmptyArrays': False
-                            }
-                        },
-                    {
-                        # These can be alter to change the number of returned values
-                         '$project':{
-                            'name' : 1,
-                            'text': 1,
-                            'email' : 1,
-                            'title' : '$movie.title',
-                            'fullplot' : "$movie.fullplot",
-                            'rated' : "$movie.rated",
-                            }
-                        }
-                    ]
-                )
-                temp = [i for i in mydoc] # Equivalent to fetchall for postgres
-            except:
-                print('\t Query failed')
-            end = time.time()
+        settings = dict(self.postgres_config[case[5]])
 
-        elif case[3] == 6:
-            start = time.time()
-            try:
-                mycol = self.mongodb["all_comments"]
-                mydoc = mycol.aggregate([
-                    {
-                        '$lookup':{
-                            'from': "movies",
-                            'localField': "movie_id",
-                            'foreignField': "_id",
-                            'as': "movie"
-                            }
-                        },
-                    {
-                        '$unwind': {
-                            'path': "$movie",
-                            'preserveNullAndEmptyArrays': False
-                            }
-                        },
-                    {
-                        '$match': {
-                            '$or': [
-                                {'movie.year': { '$eq': 1950}},
-                                {'movie.year': { '$eq': 1951}},
-                                {'movie.year': { '$eq': 1952}},
-                                {'movie.year': { '$eq': 1953}},
-                                {'movie.year': { '$eq': 1954}}
-                                ]
-                            }
-                        },
-                    {
-                        # These can be alter to change the number of returned values
-                         '$project':{
-                            'name' : 1,
-                            'text': 1,
-                            'email' : 1,
-                            'title' : '$movie.title',
-                            'fullplot' : "$movie.fullplot",
-                            'rated' : "$movie.rated"
-                            }
-                        }
-                    ])
-                temp = [i for i in mydoc] # Equivalent to fetchall for postgres
-            except:
-                print('\t Query failed')
-            end = time.time()
+        # The optimized queries read the copies of the tables they were written for, the other tables from the public schema
+        if (case[1] == 0) & (self.query_variant[case[7]] == 'optimized'):
+            settings['search_path'] = '{}, public'.format(self.optimized_schema)
 
-        elif case[3] == 7:
-            start = time.time()
-            try:
-                mycol = self.mongodb["all_comments"]
-                mydoc = mycol.aggregate([
-                    {
-                        '$lookup':{
-                            'from': "movies",
-                            'localField': "movie_id",
-                            'foreignField': "_id",
-                            'as': "movie"
-                            }
-                        },
-                    {
-                        '$unwind': {
-                            'path': "$movie",
-                            'preserveNullAndEmptyArrays': False
-                            }
-                        },
-                    {
-                        '$lookup':{
-                            'from': "users",
-                            'localField': "name",
-                            'foreignField': "name",
-                            'as': "user"
-                            }
-                        },
-                    {
-                        '$unwind': {
-                            'path': "$user",
-                            'preserveNullAndEmptyArrays': False
-                            }
-                        },
-                    {
-                        '$match': {
-                            '$or': [
-                                {'movie.year': { '$eq': 1950}},
-                                {'movie.year': { '$eq': 1951}},
-                                {'movie.year': { '$eq': 1952}},
-                                {'movie.year': { '$eq': 1953}},
-                                {'movie.year': { '$eq': 1954}}
-                                ]
-                            }
-                        }
-                    ])
-                temp = [i for i in mydoc] # Equivalent to fetchall for postgres
-            except:
-                print('\t Query failed')
-            end = time.time()
+        if self.time_budget is not None:
+            settings['statement_timeout'] = self.time_budget
 
-        elif case[3] == 8:
-            start = time.time()
-            try:
-                mycol = self.mongodb["all_comments"]
-                mydoc = mycol.aggregate([
-                    {
-                        '$lookup':{
-                            'from': "movies",
-                            'localField': "movie_id",
-                            'foreignField': "_id",
-                            'as': "movie"
-                            }
-                        },
-                    {
-                        '$unwind': {
-                            'path': "$movie",
-                            'preserveNullAndEmptyArrays': False
-                            }
-                        },
-                    {
-                        '$lookup':{
-                            'from': "users",
-                            'localField': "name",
-                            'foreignField': "name",
-                            'as': "user"
-                            }
-                        },
-                    {
-                        '$unwind': {
-                            'path': "$user",
-                            'preserveNullAndEmptyArrays': False
-                            }
-                        },
-                    {
-                        # These can be alter to change the number of returned values
-                         '$project':{
-                            'name' : 1,
-                            'email' : 1,
-                            'title' : '$movie.title',
-                            'fullplot' : "$movie.fullplot",
-                            'rated' : "$movie.rated",
-                            'password': '$user.password'
-                            }
-                        }
-                    ])
-                temp = [i for i in mydoc] # Equivalent to fetchall for postgres
-            except:
-                print('\t Query failed')
-            end = time.time()
+        for name, value in settings.items():
+            if isinstance(value, bool):
+                value = 'on' if value else 'off'
+            settings[name] = str(value)
 
-        elif case[3] == 9:
-            start = time.time()
+        return settings
+
+    def start_load(self, case):
+
+        # Load clients repeat the query with the parameter values of the first trial
+        clients = self.concurrency[case[11]] - 1
+
+        try:
+            query = self.bind_query(case)
+
+            if case[1] != 1: # data_store 0 postgres and 2 jsonb in postgres
+                target = postgres_load_client
+                args = (self.postgres_settings, query, self.postgres_trial_settings(case), self.load_interval)
+            else: # data_store 1 mongodb
+                options = self.mongodb_options[case[6]]
+                target = mongodb_load_client
+                args = (self.mongodb_host, self.mongodb_settings['database'], query, options, self.mongodb_query_kwargs(query, options), self.load_interval)
+
+            self.load_clients = LoadClients(clients, target, args)
+            self.load_clients.start()
+        except:
+            print('\t Start of {} load clients failed, the trials of query {} are logged as failed'.format(clients, self.query[case[3]]))
+            self.load_clients = None
+            self.load_failed = True
+
+    def stop_load(self, case):
+
+        if self.load_clients is None:
+            return
+
+        histogram = self.load_clients.stop()
+        elapsed = self.load_clients.elapsed
+        self.load_clients = None
+
+        self.load_histograms.setdefault(self.histogram_key(case), LatencyHistogram()).merge(histogram)
+        self.load_durations[self.histogram_key(case)] = self.load_durations.get(self.histogram_key(case), 0) + elapsed
+
+        print('\t \t Load clients completed query {} {} times in {} s ({} queries/s) with p50 {} ms and p99 {} ms'.format(self.query[case[3]], histogram.total, round(elapsed, 3), round(histogram.total/elapsed, 1), histogram.percentile(50), histogram.percentile(99)))
+
+    def run_postgres_query(self, case):
+
+        # Apply the session settings and time budget to this trial only, the settings end with the transaction
+        try:
+            for name, value in self.postgres_trial_settings(case).items():
+                self.postgres_cur.execute("SELECT set_config(%s, %s, true)", (name, value))
+        except:
+            print('\t Session settings of the trial failed')
+            self.postgres_con.rollback()
+            self.log_trial(case, np.nan, 'failed')
+            return
+
+        template = self.get_query_strings(case)[case[3]-1]
+        try:
+            query = self.bind_query(case)
+        except:
+            print('\t Binding of the query parameters failed')
+            self.postgres_con.rollback()
+            self.log_trial(case, np.nan, 'failed')
+            return
+        materialization = self.materialization[case[10]]
+
+        # Describe the columns before the timing starts, a failed description also fails the query below
+        if (materialization != 'rows') & (template not in self.column_types):
             try:
-                mycol = self.mongodb["all_comments"]
-                mydoc = mycol.aggregate([
-                    {
-                        '$lookup':{
-                            'from': "movies",
-                            'localField': "movie_id",
-                            'foreignField': "_id",
-                            'as': "movie"
-                            }
-                        },
-                    {
-                        '$unwind': {
-                            'path': "$movie",
-                            'preserveNullAndEmptyArrays': False
-                            }
-                        },
-                    {
-                        '$lookup':{
-                            'from': "users",
-                            'localField': "name",
-                            'foreignField': "name",
-                            'as': "user"
-                            }
-                        },
-                    {
-                        '$unwind': {
-                            'path': "$user",
-                            'preserveNullAndEmptyArrays': False
-                            }
-                        },
-                    {
-                        '$match': {
-                            '$or': [
-                                {'movie.year': { '$eq': 1950}},
-                                {'movie.year': { '$eq': 1951}},
-                                {'movie.year': { '$eq': 1952}},
-                                {'movie.year': { '$eq': 1953}},
-                                {'movie.year': { '$eq': 1954}}
-                                ]
-                            }
-                        },
-                    {
-                        # These can be alter to change the number of returned values
-                         '$project':{
-                            'name' : 1,
-                            'email' : 1,
-                            'title' : '$movie.title',
-                            'fullplot' : "$movie.fullplot",
-                            'rated' : "$movie.rated",
-                            'password': '$user.password'
-                            }
-                        }
-                    ])
-                temp = [i for i in mydoc] # Equivalent to fetchall for postgres
+                self.column_types[template] = self.describe_postgres(query)
             except:
-                print('\t Query failed')
-            end = time.time()
+                pass
+
+        self.start_trial()
+        start = time.time()
+        cache_hit = None
+        try:
+            cache_hit = self.read_result(case, lambda: self.fetch_postgres(query, materialization, self.column_types.get(template)))
+            status = 'ok'
+        except psycopg2.extensions.QueryCanceledError:
+            print('\t \t \t Time limit exceeded')
+            status = 'timed out'
+        except:
+            print('\t Query failed')
+            status = 'failed'
+        end = time.time()
+        peak_memory = self.stop_trial()
+
+        # End the transaction, this also recovers the connection after a failed query
+        self.postgres_con.rollback()
+
+        self.log_trial(case, (end-start)*1000, status, cache_hit, peak_memory)
+
+    def describe_postgres(self, query):
+
+        self.postgres_cur.execute('SELECT * FROM ({}) AS query LIMIT 0'.format(query.strip().rstrip(';')))
+
+        return ([column.name for column in self.postgres_cur.description],
+                [column.type_code for column in self.postgres_cur.description])
+
+    def fetch_postgres(self, query, materialization='rows', column_types=None):
+
+        if materialization == 'rows':
+            self.postgres_cur.execute(query)
 
-        elif case[3] == 10:
             start = time.time()
-            try:
-                mycol = self.mongodb["movies_info"]
-                mydoc = mycol.aggregate([
-                        {
-                        '$match': {
-                            '$or': [
-                                {'year': { '$eq': 1950}},
-                                {'year': { '$eq': 1951}},
-                                {'year': { '$eq': 1952}},
-                                {'year': { '$eq': 1953}},
-                                {'year': { '$eq': 1954}}
-                                ]
-                            }
-                        },
-                    {
-                        "$group" : {
-                            '_id':"$runtime", 'count':{'$sum':1}}}
-                ])
-                temp = [i for i in mydoc] # Equivalent to fetchall for postgres
-            except:
-                print('\t Query failed')
-            end = time.time()
+            result = self.postgres_cur.fetchall()
+            self.conversion_time = (time.time()-start)*1000
+
+            return result
+
+        # Stream the result in the binary COPY format and decode it into columns
+        from _materialize import decode_pg_binary, to_arrow
+        buffer = io.BytesIO()
+        self.postgres_cur.copy_expert('COPY ({}) TO STDOUT WITH (FORMAT binary)'.format(query.strip().rstrip(';')), buffer)
+
+        start = time.time()
+        names, type_oids = column_types
+        result = decode_pg_binary(buffer.getbuffer(), names, type_oids)
+        if materialization == 'arrow':
+            result = to_arrow(result)
+        self.conversion_time = (time.time()-start)*1000
+
+        return result
+
+    def get_mongodb(self, options):
+
+        # Compression is negotiated per client, so a client is kept for each host and compressor setting
+        compressors = options.get('compressors')
+        if compressors is None:
+            return self.mongodb
+
+        if (self.mongodb_host, compressors) not in self.mongoclients:
+            self.mongoclients[(self.mongodb_host, compressors)] = pymongo.MongoClient(self.mongodb_host, compressors=compressors)
+
+        return self.mongoclients[(self.mongodb_host, compressors)][self.mongodb_settings['database']]
 
-        elif case[3] == 11:
+    def mongodb_query_kwargs(self, spec, options):
+
+        hint = options.get('hint', {}).get(spec['collection'])
+
+        # Find and aggregate name the same options differently
+        if spec['method'] == 'find':
+            kwargs = {'max_time_ms': self.time_budget}
+            if 'allowDiskUse' in options:
+                kwargs['allow_disk_use'] = options['allowDiskUse']
+            if 'batchSize' in options:
+                kwargs['batch_size'] = options['batchSize']
+            if hint is not None:
+                kwargs['hint'] = list(hint.items()) if isinstance(hint, dict) else hint
+        else:
+            kwargs = {}
+            if self.time_budget is not None:
+                kwargs['maxTimeMS'] = self.time_budget
+            for name in ['allowDiskUse', 'batchSize']:
+                if name in options:
+                    kwargs[name] = options[name]
+            if hint is not None:
+                kwargs['hint'] = hint
+
+        return kwargs
+
+    def run_mongodb_query(self, case):
+
+        try:
+            spec = self.bind_query(case)
+        except:
+            print('\t Binding of the query parameters failed')
+            self.log_trial(case, np.nan, 'failed')
+            return
+
+        options = self.mongodb_options[case[6]]
+        kwargs = self.mongodb_query_kwargs(spec, options)
+        materialization = self.materialization[case[10]]
+
+        self.start_trial()
+        start = time.time()
+        cache_hit = None
+        try:
+            cache_hit = self.read_result(case, lambda: self.fetch_mongodb(spec, options, kwargs, materialization))
+            status = 'ok'
+        except pymongo.errors.ExecutionTimeout:
+            print('\t \t \t Time limit exceeded')
+            status = 'timed out'
+        except:
+            print('\t Query failed')
+            status = 'failed'
+        end = time.time()
+        peak_memory = self.stop_trial()
+
+        self.log_trial(case, (end-start)*1000, status, cache_hit, peak_memory)
+
+    def fetch_mongodb(self, spec, options, kwargs, materialization='rows'):
+
+        mycol = self.get_mongodb(options)[spec['collection']]
+        if 'readConcern' in options:
+            mycol = mycol.with_options(read_concern=ReadConcern(options['readConcern']))
+
+        # The columnar materializations read undecoded BSON batches
+        raw = materialization != 'rows'
+
+        if spec['method'] == 'find':
+            find = mycol.find_raw_batches if raw else mycol.find
+            mydoc = find(spec['filter'], spec.get('projection'), **kwargs)
+            if 'sort' in spec:
+                mydoc = mydoc.sort([tuple(key) for key in spec['sort']])
+        else:
+            aggregate = mycol.aggregate_raw_batches if raw else mycol.aggregate
+            mydoc = aggregate(spec['pipeline'], **kwargs)
+
+        if not raw:
+            return [i for i in mydoc] # Equivalent to fetchall for postgres
+
+        # Decode each batch into the columns as it arrives, only the decoding is conversion time
+        from _materialize import ColumnBuilder, to_arrow
+        builder = ColumnBuilder()
+        conversion_time = 0
+        for batch in mydoc:
             start = time.time()
+            builder.add_batch(batch)
+            conversion_time += time.time()-start
+
+        start = time.time()
+        result = builder.to_arrays()
+        if materialization == 'arrow':
+            result = to_arrow(result)
+        self.conversion_time = (conversion_time + time.time()-start)*1000
+
+        return result
+
+    def profile_query(self, case):
+
+        # Queries that exceeded their time budget or failed in every trial are not profiled
+        if self.histograms.get(self.histogram_key(case)) is None:
+            self.profiler = None
+            return
+
+        source = 'trials'
+        if self.profiler is None:
+
+            # Run the query once more outside the timed trials, without the result cache
+            source = 'untimed'
+            self.profiler = QueryProfiler(self.profile.get('interval', 1))
+            materialization = self.materialization[case[10]]
             try:
-                mycol = self.mongodb["all_comments"]
-                mydoc = mycol.aggregate([
-                    {
-                        '$lookup':{
-                            'from': "movies",
-                            'localField': "movie_id",
-                            'foreignField': "_id",
-                            'as': "movie"
-                            }
-                        },
-                    {
-                        '$unwind': {
-                            'path': "$movie",
-                            'preserveNullAndEmptyArrays': False
-                            }
-                        },
-                    {
-                        '$match': {
-                            '$or': [
-                                {'movie.year': { '$eq': 1950}},
-                                {'movie.year': { '$eq': 1951}},
-                                {'movie.year': { '$eq': 1952}},
-                                {'movie.year': { '$eq': 1953}},
-                                {'movie.year': { '$eq': 1954}}
-                                ]
-                            }
-                        },
-                    {
-                        '$match': {
-                            '$or': [
-                                {'name': 'Theon Greyjoy'},
-                                {'name': 'Jorah Mormont'},
-                                {'name': 'Daario Naharis'},
-                                {'name': 'Meera Reed'},
-                                {'name': 'Olly'}
-                                ]
-                            }
-                        },
-                    {
-                        "$group" : {
-                            '_id':"$movie.year", 'count':{'$sum':1}}
-                    }
-                    ])
-                temp = [i for i in mydoc] # Equivalent to fetchall for postgres
+                query = self.bind_query(case)
+                if case[1] != 1: # data_store 0 postgres and 2 jsonb in postgres
+                    for name, value in self.postgres_trial_settings(case).items():
+                        self.postgres_cur.execute("SELECT set_config(%s, %s, true)", (name, value))
+                    column_types = self.column_types.get(self.get_query_strings(case)[case[3]-1])
+                    self.profiler.run(lambda: self.fetch_postgres(query, materialization, column_types))
+                else: # data_store 1 mongodb
+                    options = self.mongodb_options[case[6]]
+                    self.profiler.run(lambda: self.fetch_mongodb(query, options, self.mongodb_query_kwargs(query, options), materialization))
+                failed = False
             except:
-                print('\t Query failed')
-            end = time.time()
+                print('\t Profiling of query {} failed'.format(self.query[case[3]]))
+                failed = True
+
+            # End the transaction, this also recovers the connection after failed session settings or a failed query
+            if case[1] != 1:
+                self.postgres_con.rollback()
+
+            # A failed run has no profile to write
+            if failed:
+                self.profiler = None
+                return
+
+        # One file per query, data size and config, named by the ids of its case
+        name = '{}_{}_{}_{}_'.format(self.data_set[case[0]], self.data_store[case[1]], self.data_size[case[2]][case[0]], self.query[case[3]]) + '_'.join(str(key) for key in case[5:])
+        try:
+            self.profiler.write(self.profile.get('path', 'profiles'), name)
+        except:
+            print('\t Writing the profile of query {} failed'.format(self.query[case[3]]))
+
+        summary = self.profiler.summary()
+        self.profiler = None
+        row = {"person": self.person,
+               "data_set": self.data_set[case[0]],
+               "data_store": self.data_store[case[1]],
+               "data_size": self.data_size[case[2]][case[0]],
+               "query": self.query[case[3]],
+               "postgres_config": self.config_label(self.postgres_config[case[5]]) if case[1] != 1 else 'n/a',
+               "mongodb_options": self.config_label(self.mongodb_options[case[6]]) if case[1] == 1 else 'n/a',
+               "query_variant": self.query_variant[case[7]],
+               "materialization": self.materialization[case[10]],
+               "concurrency": self.concurrency[case[11]],
+               "source": source,
+               "file": name}
+        row.update(summary)
+        self.profiles.append(row)
+
+        print('\t \t Profiled query {} in {} ms: driver {} ms, network {} ms, user {} ms'.format(self.query[case[3]], round(summary['wall_time'], 3), round(summary['driver_time'], 3), round(summary['network_time'], 3), round(summary['user_time'], 3)))
+
+    def reset_cache(self, case):
 
+        if len(self.cache_hits) > 0:
+            print('\t \t Executed query {} {} times through the result cache with hit rate {}'.format(self.query[case[3]],len(self.cache_hits),np.mean(self.cache_hits)))
+
+        histogram = self.histograms.get(self.histogram_key(case))
+        if histogram is not None:
+            print('\t \t Executed query {} {} times with avg. response time {} ms'.format(self.query[case[3]],histogram.total,histogram.mean()))
+        elif self.timed_out.get(self.query_key(case), case[2]) < case[2]:
+            print('\t \t Skipped query {}, time budget exceeded at data size {}'.format(self.query[case[3]],self.data_size[self.timed_out[self.query_key(case)]][case[0]]))
         else:
-            print('\t No query defined')
+            print('\t \t Query {} did not complete in any trial'.format(self.query[case[3]]))
+
+        self.cache_hits = []
 
-        response_time = (end-start)*1000
+    def run_query(self, case):
 
-        return response_time
+        if self.loaded.get(case[1]) != (case[0], case[2], case[9], case[13]):
 
-    def run_mongodb_query(self, case):
+            # The import of the data of this query failed
+            self.log_response_time(case, np.nan, 'failed')
+
+        elif self.timed_out.get(self.query_key(case), case[2]) < case[2]:
+
+            # Query exceeded its time budget at a smaller data size
+            self.log_response_time(case, np.nan, 'skipped')
 
-        if case[0] == 0:
-            response_time = self.run_mongodb_query_arrest(case)
         else:
-            response_time = self.run_mongodb_query_movies(case)
 
-        # Log response time
-        self.log_response_time(case, response_time)
+            if (case[4] == self.plan_keys[4][0]) & (self.concurrency[case[11]] > 1): # first trail with concurrency
 
-        # Cache the response time
-        self.cache.append(response_time)
+                # Start the load clients that run alongside the trials of this query
+                self.start_load(case)
 
-    def reset_cache(self, case):
+            if (case[4] == self.plan_keys[4][0]) & (self.profile is not None) and self.profile.get('trials', False) and (not self.load_failed): # first trail with profiled trials
 
-        print('\t \t Executed query {} 10 times with avg. response time {} ms'.format(self.query[case[3]],np.mean(self.cache)))
+                # Profile the timed trials of this query
+                self.profiler = QueryProfiler(self.profile.get('interval', 1))
 
-        self.cache = []
+            if self.load_failed:
 
-    def run_query(self, case):
+                # Without its load clients the trial would not run under the concurrency it is logged with
+                self.log_response_time(case, np.nan, 'failed')
 
-        if case[1] == 0: # data_store 0 postgres
+            elif case[1] != 1: # data_store 0 postgres and 2 jsonb in postgres
+
+                # Execute query in postgres
+                self.run_postgres_query(case)
 
-            # Execute query in postgres
-            self.run_postgres_query(case)
+            else: # data_store 1 mongodb
 
-            if case[4] == 9: # Final trail of query completed
-                self.reset_cache(case)
+                # Execute query in mongodb
+                self.run_mongodb_query(case)
 
-        else: # data_store 1 mongodb
+        if case[4] == self.plan_keys[4][-1]: # Final trail of query completed
+            self.stop_load(case)
+            self.load_failed = False
+            if self.profile is not None:
+                self.profile_query(case)
+            self.reset_cache(case)
 
-            # Execute query in mongodb
-            self.run_mongodb_query(case)
+    def check_prepared(self, filters):
 
-            if case[4] == 9: # Final trail of query completed
-                self.reset_cache(case)
+        # The data stores and the tables and indexes of the query families are set up for the stores and queries prepared
+        for dimension in [1, 3]:
+            missing = sorted(set(self.planned_keys(dimension, filters)) - set(self.planned_keys(dimension, self.prepared_filters)))
+            if len(missing) > 0:
+                raise ValueError('The {} ids {} were not prepared, add them to the filters before prepare_databases'.format(self.dimension_names[dimension], missing))
 
-    def execute(self, person):
+    def execute(self, person, filters=None):
         self.person = person
 
-        # Run all experiments
-        for case in self.cases:
+        # Filters of this run may narrow the prepared filters, but not widen them
+        self.check_prepared(self.filters if filters is None else filters)
 
-            if (case[3] == 0) & (case[4] == 0): # query 0 and trail 0
+        # Time budgets and latency histograms are tracked per execution
+        self.timed_out = {}
+        self.histograms = {}
+        self.load_histograms = {}
+        self.load_durations = {}
+
+        # Each execution is a run in the results history
+        self.run_id = '{}_{}'.format(time.strftime('%Y%m%dT%H%M%S'), person)
+        self.collect_metadata(self.filters if filters is None else filters)
+
+        # Run all experiments, the cases are planned as the run goes
+        for case in self.plan_cases(filters):
+
+            if case[3] == 0: # query 0
                 # Update database
                 self.update_databases(case)
-            elif case[3] == 0: # query 0
-                continue # Import query is run only once in the update_databases step above
             else:
                 # run query
                 self.run_query(case)
 
+        # Stop the load clients and local clusters that are still running
+        if self.load_clients is not None:
+            self.load_clients.stop()
+            self.load_clients = None
+        self.stop_clusters()
+
+    def collect_metadata(self, filters):
+
+        # Versions, configs and hardware of the run, so results of different runs can be compared
+        metadata = {'run_id': self.run_id,
+                    'started': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                    'git_commit': git_commit(os.path.dirname(os.path.abspath(__file__))),
+                    'host': host_metadata(),
+                    'client': {'psycopg2': psycopg2.__version__,
+                               'pymongo': pymongo.version,
+                               'numpy': np.__version__,
+                               'cpus': sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else None},
+                    'postgres': None,
+                    'mongodb': None,
+                    'local_servers': {name: server.get_metadata() for name, server in self.local_servers.items()},
+                    'profile': self.profile}
+
+        if (0 in self.planned_keys(1, filters)) or (2 in self.planned_keys(1, filters)):
+            try:
+                self.postgres_cur.execute('SELECT version()')
+                version = self.postgres_cur.fetchone()[0]
+                self.postgres_cur.execute("SELECT name, setting FROM pg_settings WHERE source NOT IN ('default', 'override')")
+                metadata['postgres'] = {'version': version, 'settings': dict(self.postgres_cur.fetchall())}
+            except:
+                print('Collection of Postgres metadata failed')
+            self.postgres_con.rollback()
+
+        if 1 in self.planned_keys(1, filters):
+            try:
+                metadata['mongodb'] = {'version': self.mongoclient.server_info()['version'],
+                                       'options': self.mongoclient.admin.command('getCmdLineOpts')['parsed']}
+            except:
+                print('Collection of MongoDB metadata failed')
+
+        self.metadata = metadata
+
+    def configure(self, config):
+
+        # Run only the listed ids of the data dimensions
+        for name, dimension_name in [('data_sets', 'data_set'), ('data_stores', 'data_store'), ('data_sizes', 'data_size'), ('queries', 'query')]:
+            if name in config:
+                self.filters[dimension_name] = config[name]
+        self.add_queries(config.get('queries', []))
+
+        # Optional data stores only run when they are selected
+        for data_store in config.get('data_stores', []):
+            if data_store in self.optional_data_stores:
+                self.data_store[data_store] = self.optional_data_stores[data_store]
+
+        if 'trials' in config:
+            self.trail.clear()
+            self.trail.update({i:str(i+1) for i in range(config['trials'])})
+
+        # Replace the values of the config dimensions, the dictionaries are updated in place to keep the dimensions current
+        for name, dimension in [('postgres_config', self.postgres_config), ('mongodb_options', self.mongodb_options), ('query_variant', self.query_variant),
+                                ('cache_mode', self.cache_mode), ('nodes', self.nodes), ('materialization', self.materialization), ('concurrency', self.concurrency),
+                                ('selectivity', self.selectivity), ('durability', self.durability)]:
+            if name in config:
+                dimension.clear()
+                dimension.update(enumerate(config[name]))
+
+        for name in ['time_budget', 'trace_memory', 'path_data', 'load_interval', 'profile', 'time_index_methods']:
+            if name in config:
+                setattr(self, name, config[name])
+
     def get_results(self):
-        return self.results
+        import pandas as pd
+        return pd.DataFrame(self.results, columns=self.result_columns)
+
+    def get_import_results(self):
+        import pandas as pd
+        return pd.DataFrame(self.import_results, columns=self.import_columns)
+
+    def get_import_summary(self):
+
+        # Throughput and commit time per import, the bytes are read from the files and the rows sent to the store
+        imports = self.get_import_results()
+        imports['bytes'] = imports['bytes'].where(imports['phase'] == 'read')
+        imports['rows'] = imports['rows'].where(imports['phase'] == 'send_apply')
+        imports['commit_time'] = imports['response_time'].where(imports['phase'] == 'commit')
+
+        summary = imports.groupby(["data_set", "data_store", "data_size", "nodes", "durability"])[['response_time', 'bytes', 'rows', 'commit_time']].sum().reset_index()
+        summary['rows_per_second'] = summary['rows'] / summary['response_time'] * 1000
+        summary['mb_per_second'] = summary['bytes'] / 1024**2 / summary['response_time'] * 1000
+
+        return summary
+
+    def get_latency_summary(self):
+        import pandas as pd
+
+        # Percentiles and queries per second per query, data size and config, of the trials and of the load clients
+        rows = []
+        for source, histograms in [('trials', self.histograms), ('load', self.load_histograms)]:
+            for key, histogram in histograms.items():
+                case = key[:4] + (0,) + key[4:]
+                row = {"data_set": self.data_set[case[0]],
+                       "data_store": self.data_store[case[1]],
+                       "data_size": self.data_size[case[2]][case[0]],
+                       "query": self.query[case[3]],
+                       "postgres_config": self.config_label(self.postgres_config[case[5]]) if case[1] != 1 else 'n/a',
+                       "mongodb_options": self.config_label(self.mongodb_options[case[6]]) if case[1] == 1 else 'n/a',
+                       "query_variant": self.query_variant[case[7]],
+                       "cache_mode": self.cache_mode[case[8]],
+                       "nodes": self.nodes[case[9]],
+                       "materialization": self.materialization[case[10]],
+                       "concurrency": self.concurrency[case[11]],
+                       "selectivity": self.selectivity[case[12]],
+                       "durability": self.config_label(self.durability[case[13]]),
+                       "source": source}
+                row.update(histogram.summary())
+
+                # The trials run one after another, so their throughput is that of one client, the load clients ran for a measured time
+                if source == 'trials':
+                    row['throughput'] = 1000 / histogram.mean() if histogram.total > 0 else np.nan
+                else:
+                    duration = self.load_durations.get(key, 0)
+                    row['throughput'] = histogram.total / duration if duration > 0 else np.nan
+                rows.append(row)
+
+        return pd.DataFrame(rows)
+
+    def get_profile_summary(self):
+        import pandas as pd
 
-    def export_results(self):
-        self.results.to_csv('exp_results_{}.csv'.format(self.person))
+        # Time per category of the profiled queries, a large share of driver and user time means the client is measured, not the database
+        summary = pd.DataFrame(self.profiles)
+        if len(summary) > 0:
+            summary['client_share'] = (summary['driver_time'] + summary['user_time']) / summary['wall_time']
+
+        return summary
+
+    def get_cache_stats(self):
+        return self.result_cache.get_stats()
+
+    def get_metadata(self):
+        return self.metadata
+
+    def export_results(self, path=None):
+        self.get_results().to_csv('exp_results_{}.csv'.format(self.person) if path is None else path)
+
+    def save_history(self, path):
+        history = ResultsHistory(path)
+        history.add_run(self.run_id, self.person, self.metadata, self.results, self.result_columns, self.import_results, self.import_columns)
+        return history
+
+    def export_profiles(self, path=None):
+        self.get_profile_summary().to_csv(os.path.join(self.profile.get('path', 'profiles'), 'profile_summary_{}.csv'.format(self.person)) if path is None else path)
+
+    def export_metadata(self, path=None):
+        with open('exp_metadata_{}.json'.format(self.person) if path is None else path, 'w') as file:
+            json.dump(self.metadata, file, indent=4, default=str)
+
+
+def parse_date(document):
+
+    if list(document.keys()) == ['$date']:
+        return datetime.datetime.fromisoformat(document['$date'])
+
+    return document
+
+
+def parse_ids(text):
+
+    # Parse a list of ids such as 1,3,5-7
+    ids = []
+    for part in text.split(','):
+        if '-' in part:
+            first, last = part.split('-')
+            ids += list(range(int(first), int(last)+1))
+        else:
+            ids.append(int(part))
+
+    return ids
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description='Measure database response times on postgres and mongoDB')
+    parser.add_argument('config', help='JSON file with the connection settings and dimensions of the run')
+    parser.add_argument('--person', help='name that labels the results')
+    parser.add_argument('--data-sets', type=parse_ids, help='data set ids, e.g. 0')
+    parser.add_argument('--stores', type=parse_ids, help='data store ids, e.g. 0,1')
+    parser.add_argument('--sizes', type=parse_ids, help='data size ids, e.g. 3,4')
+    parser.add_argument('--queries', type=parse_ids, help='query ids, e.g. 4-9')
+    parser.add_argument('--trials', type=int, help='number of trials per query')
+    parser.add_argument('--concurrency', type=parse_ids, help='numbers of concurrent clients, e.g. 1,4')
+    parser.add_argument('--output', help='CSV file for the results')
+    parser.add_argument('--history', help='SQLite file that keeps the results of every run')
+    parser.add_argument('--baseline', help='run id in the history to compare this run against')
+    parser.add_argument('--profile', help='directory for the client profiles, each query runs once more after its trials under the profiler')
+    args = parser.parse_args(argv)
+
+    with open(args.config, 'r') as file:
+        config = json.load(file)
+
+    # Command line arguments override the config file
+    for name, key in [('person', 'person'), ('data_sets', 'data_sets'), ('stores', 'data_stores'), ('sizes', 'data_sizes'),
+                      ('queries', 'queries'), ('trials', 'trials'), ('concurrency', 'concurrency'), ('output', 'output'),
+                      ('history', 'history'), ('baseline', 'baseline')]:
+        if getattr(args, name) is not None:
+            config[key] = getattr(args, name)
+    if args.profile is not None:
+        config['profile'] = dict(config.get('profile') or {}, path=args.profile)
+
+    # Pin the experiment to its own CPUs, apart from the CPUs of the local servers
+    if 'client_cpus' in config:
+        pin_client(config['client_cpus'])
+
+    exp = Experiment()
+    exp.configure(config)
+
+    try:
+        # Start throwaway local servers in place of the servers in the connection settings
+        for name, server_class in [('postgres', LocalPostgresServer), ('mongodb', LocalMongoServer)]:
+            if name in config.get('local_servers', {}):
+                exp.local_servers[name] = server_class(**config['local_servers'][name])
+                exp.local_servers[name].start()
+
+        if 'postgres' in exp.local_servers:
+            config['postgres_settings'] = exp.local_servers['postgres'].settings
+        if 'mongodb' in exp.local_servers:
+            config['mongodb_settings'] = dict(config.get('mongodb_settings', {'database': 'bigdata'}), host=exp.local_servers['mongodb'].host)
+
+        exp.connect(config['postgres_settings'], config['mongodb_settings'])
+        exp.prepare_databases(config.get('path_queries', os.getcwd()))
+        exp.execute(config['person'])
+        exp.export_results(config.get('output'))
+        exp.export_metadata(None if config.get('output') is None else os.path.splitext(config['output'])[0] + '.json')
+        if exp.profile is not None:
+            exp.export_profiles()
+    finally:
+        for server in exp.local_servers.values():
+            server.stop()
+
+    if 'history' not in config:
+        return 0
+
+    # Store the run and compare it against the baseline run
+    history = exp.save_history(config['history'])
+    if 'baseline' not in config:
+        return 0
+
+    comparison = history.compare(config['baseline'], exp.run_id, config.get('alpha', 0.05), config.get('min_change', 0.1))
+    print_comparison(comparison, config['baseline'], exp.run_id)
+
+    return 1 if any(row['verdict'] == 'regression' for row in comparison) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,133 @@
+import numpy as np
+
+
+class LatencyHistogram:
+
+    """
+    HDR style histogram of latencies with log-bucketed counts in a fixed size array, latencies are given in ms and counted in microseconds
+    """
+
+    def __init__(self, highest_us=3600*10**6, significant_figures=3):
+        self.highest_us = highest_us
+        self.significant_figures = significant_figures
+
+        # Each bucket covers a power of two with enough sub-buckets for the significant figures
+        self.sub_bucket_magnitude = int(np.ceil(np.log2(2 * 10**significant_figures)))
+        self.sub_bucket_half = 2**(self.sub_bucket_magnitude-1)
+        self.counts = np.zeros(self.index(highest_us)+1, dtype=np.int64)
+
+        self.total = 0
+        self.min_us = None
+        self.max_us = None
+
+    def index(self, value):
+
+        bucket = max(value.bit_length() - self.sub_bucket_magnitude, 0)
+
+        return bucket*self.sub_bucket_half + (value >> bucket)
+
+    def lowest_value(self, index):
+
+        bucket = max(index // self.sub_bucket_half - 1, 0)
+
+        return (index - bucket*self.sub_bucket_half) << bucket
+
+    def highest_value(self, index):
+
+        bucket = max(index // self.sub_bucket_half - 1, 0)
+
+        return self.lowest_value(index) + (1 << bucket) - 1
+
+    def record_us(self, value, count=1):
+
+        # Values above the range are counted in the highest bucket
+        value = min(max(int(value), 0), self.highest_us)
+
+        self.counts[self.index(value)] += count
+        self.total += count
+        self.min_us = value if self.min_us is None else min(self.min_us, value)
+        self.max_us = value if self.max_us is None else max(self.max_us, value)
+
+    def record(self, latency, expected_interval=None):
+
+        value = int(round(latency*1000))
+        self.record_us(value)
+
+        # Coordinated omission: a client that waits for a slow response skips the requests it should have sent meanwhile,
+        # record the latencies those requests would have seen
+        if expected_interval is not None:
+            interval = int(round(expected_interval*1000))
+            if interval > 0:
+                missed = value - interval
+                while missed >= interval:
+                    self.record_us(missed)
+                    missed -= interval
+
+    def merge(self, other):
+
+        if (other.highest_us != self.highest_us) or (other.significant_figures != self.significant_figures):
+            raise ValueError('Histograms with different ranges or precision cannot be merged')
+
+        self.counts += other.counts
+        self.total += other.total
+        for value in [other.min_us, other.max_us]:
+            if value is not None:
+                self.min_us = value if self.min_us is None else min(self.min_us, value)
+                self.max_us = value if self.max_us is None else max(self.max_us, value)
+
+    def percentile(self, percentile):
+
+        if self.total == 0:
+            return np.nan
+
+        # Highest value of the bucket that holds the requested rank, as HDR histograms report it
+        rank = max(int(np.ceil(round(percentile / 100 * self.total, 9))), 1)
+        index = int(np.searchsorted(np.cumsum(self.counts), rank))
+
+        return min(self.highest_value(index), self.max_us) / 1000
+
+    def mean(self):
+
+        if self.total == 0:
+            return np.nan
+
+        # Middle of each bucket
+        indexes = np.nonzero(self.counts)[0]
+        values = [(self.lowest_value(index) + self.highest_value(index)) / 2 for index in indexes]
+
+        return np.dot(values, self.counts[indexes]) / self.total / 1000
+
+    def summary(self, percentiles=(50, 90, 99, 99.9)):
+
+        summary = {'count': self.total,
+                   'min': np.nan if self.min_us is None else self.min_us / 1000,
+                   'mean': self.mean()}
+        for percentile in percentiles:
+            summary['p{}'.format(percentile)] = self.percentile(percentile)
+        summary['max'] = np.nan if self.max_us is None else self.max_us / 1000
+
+        return summary
+
+    def to_dict(self):
+
+        # Only the buckets with counts, so a histogram is cheap to send between processes or store as JSON
+        indexes = np.nonzero(self.counts)[0]
+
+        return {'highest_us': self.highest_us,
+                'significant_figures': self.significant_figures,
+                'total': self.total,
+                'min_us': self.min_us,
+                'max_us': self.max_us,
+                'indexes': indexes.tolist(),
+                'counts': self.counts[indexes].tolist()}
+
+    @classmethod
+    def from_dict(cls, data):
+
+        histogram = cls(data['highest_us'], data['significant_figures'])
+        histogram.counts[data['indexes']] = data['counts']
+        histogram.total = data['total']
+        histogram.min_us = data['min_us']
+        histogram.max_us = data['max_us']
+
+        return histogram
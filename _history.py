@@ -0,0 +1,222 @@
+"""
+Keeps the results of every run in a SQLite database and compares runs against a baseline
+"""
+
+import os
+import sys
+import json
+import math
+import sqlite3
+import argparse
+import subprocess
+import numpy as np
+
+
+# Columns that identify a comparable cell of two runs
+CELL_COLUMNS = ['data_store', 'data_set', 'data_size', 'query', 'postgres_config', 'mongodb_options',
+                'query_variant', 'cache_mode', 'nodes', 'materialization', 'concurrency', 'selectivity',
+                'durability']
+
+
+def git_commit(path):
+
+    # Commit of the code that ran the experiment, None outside a git checkout
+    try:
+        output = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=path, capture_output=True, text=True, check=True)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+    return output.stdout.strip()
+
+
+def sql_value(value):
+
+    # SQLite stores NumPy scalars as Python values and NaN as NULL
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float) and math.isnan(value):
+        return None
+
+    return value
+
+
+def rank_data(values):
+
+    # Ranks starting at 1, tied values get the average of their ranks
+    order = np.argsort(values, kind='mergesort')
+    ranks = np.empty(len(values))
+    ranks[order] = np.arange(1, len(values)+1)
+
+    unique, inverse, counts = np.unique(values, return_inverse=True, return_counts=True)
+
+    return (np.bincount(inverse, weights=ranks) / counts)[inverse]
+
+
+def mann_whitney(x, y):
+
+    """
+    Two-sided Mann-Whitney U test of two samples, using the normal approximation with tie and continuity correction
+    """
+
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    n1, n2 = len(x), len(y)
+    n = n1 + n2
+
+    values = np.concatenate([x, y])
+    u = rank_data(values)[:n1].sum() - n1*(n1+1)/2
+
+    counts = np.unique(values, return_counts=True)[1]
+    variance = n1*n2/12 * ((n+1) - (counts**3 - counts).sum()/(n*(n-1)))
+    if variance <= 0:
+        return u, 1.0
+
+    z = max(abs(u - n1*n2/2) - 0.5, 0) / math.sqrt(variance)
+
+    return u, min(math.erfc(z/math.sqrt(2)), 1.0)
+
+
+class ResultsHistory:
+
+    """
+    Class designed to store the results of runs in SQLite, keyed by run id with the commit, server versions and config of each run
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.con = sqlite3.connect(path)
+        self.con.execute("""
+        CREATE TABLE IF NOT EXISTS runs (
+            run_id TEXT PRIMARY KEY,
+            person TEXT,
+            started TEXT,
+            git_commit TEXT,
+            postgres_version TEXT,
+            mongodb_version TEXT,
+            metadata TEXT)
+        """)
+        self.con.commit()
+
+    def insert_rows(self, table, run_id, rows, columns):
+
+        self.con.execute('CREATE TABLE IF NOT EXISTS {} (run_id TEXT)'.format(table))
+
+        # Add the columns that runs of older versions of the experiment did not have
+        existing = [row[1] for row in self.con.execute('PRAGMA table_info({})'.format(table))]
+        for column in columns:
+            if column not in existing:
+                self.con.execute('ALTER TABLE {} ADD COLUMN "{}"'.format(table, column))
+
+        self.con.executemany('INSERT INTO {} (run_id, {}) VALUES (?, {})'.format(table, ', '.join('"{}"'.format(column) for column in columns), ', '.join('?' for column in columns)),
+                             [[run_id] + [sql_value(row[column]) for column in columns] for row in rows])
+
+    def add_run(self, run_id, person, metadata, results, result_columns, import_results, import_columns):
+
+        postgres = metadata.get('postgres') or {}
+        mongodb = metadata.get('mongodb') or {}
+
+        self.con.execute('INSERT INTO runs VALUES (?, ?, ?, ?, ?, ?, ?)',
+                         (run_id, person, metadata.get('started'), metadata.get('git_commit'), postgres.get('version'), mongodb.get('version'), json.dumps(metadata, default=str)))
+        self.insert_rows('results', run_id, results, result_columns)
+        self.insert_rows('import_results', run_id, import_results, import_columns)
+        self.con.commit()
+
+        print('Stored run {} in {}'.format(run_id, self.path))
+
+    def list_runs(self):
+
+        return self.con.execute('SELECT run_id, person, started, git_commit, postgres_version, mongodb_version FROM runs ORDER BY started').fetchall()
+
+    def latest_run(self):
+
+        row = self.con.execute('SELECT run_id FROM runs ORDER BY started DESC LIMIT 1').fetchone()
+
+        return None if row is None else row[0]
+
+    def get_samples(self, run_id):
+
+        # Response times of the completed trials per cell
+        columns = ', '.join('"{}"'.format(column) for column in CELL_COLUMNS)
+        rows = self.con.execute("SELECT {}, response_time FROM results WHERE run_id = ? AND status = 'ok' AND query NOT IN ('import', 'import + index')".format(columns), (run_id,))
+
+        samples = {}
+        for row in rows:
+            samples.setdefault(tuple(row[:-1]), []).append(row[-1])
+
+        return samples
+
+    def compare(self, baseline, candidate, alpha=0.05, min_change=0.1):
+
+        """
+        Tests each cell of the candidate run against the baseline run, a cell changed when the test is significant
+        and the median moved by more than min_change
+        """
+
+        baseline_samples = self.get_samples(baseline)
+        candidate_samples = self.get_samples(candidate)
+
+        comparison = []
+        for cell in sorted(set(baseline_samples) & set(candidate_samples), key=str):
+            x = baseline_samples[cell]
+            y = candidate_samples[cell]
+            u, p = mann_whitney(x, y)
+            change = np.median(y) / np.median(x) - 1 if np.median(x) > 0 else np.nan
+
+            if (p < alpha) and (change > min_change):
+                verdict = 'regression'
+            elif (p < alpha) and (change < -min_change):
+                verdict = 'speedup'
+            else:
+                verdict = 'no change'
+
+            row = dict(zip(CELL_COLUMNS, cell))
+            row.update({'baseline_median': np.median(x), 'candidate_median': np.median(y), 'change': change, 'p_value': p, 'verdict': verdict})
+            comparison.append(row)
+
+        return comparison
+
+
+def print_comparison(comparison, baseline, candidate):
+
+    print('Comparison of run {} against baseline {}'.format(candidate, baseline))
+    for row in comparison:
+        if row['verdict'] != 'no change':
+            print('\t {} on {} {} size {} query {} ({}): {} ms -> {} ms ({:+.1%}, p={:.4f})'.format(
+                row['verdict'], row['data_store'], row['data_set'], row['data_size'], row['query'], row['query_variant'],
+                row['baseline_median'], row['candidate_median'], row['change'], row['p_value']))
+
+    for verdict in ['regression', 'speedup', 'no change']:
+        print('\t {} cells with {}'.format(sum(row['verdict'] == verdict for row in comparison), verdict))
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description='Compare a run in the results history against a baseline run')
+    parser.add_argument('history', help='SQLite file with the results history')
+    parser.add_argument('--list', action='store_true', help='list the stored runs')
+    parser.add_argument('--baseline', help='run id of the baseline')
+    parser.add_argument('--candidate', help='run id to compare, the latest run by default')
+    parser.add_argument('--alpha', type=float, default=0.05, help='significance level of the Mann-Whitney test')
+    parser.add_argument('--min-change', type=float, default=0.1, help='smallest relative change of the median that counts')
+    args = parser.parse_args(argv)
+
+    if not os.path.exists(args.history):
+        parser.error('{} does not exist'.format(args.history))
+
+    history = ResultsHistory(args.history)
+
+    if args.list or (args.baseline is None):
+        for run in history.list_runs():
+            print('\t'.join('' if value is None else str(value) for value in run))
+        return 0
+
+    candidate = history.latest_run() if args.candidate is None else args.candidate
+    comparison = history.compare(args.baseline, candidate, args.alpha, args.min_change)
+    print_comparison(comparison, args.baseline, candidate)
+
+    # A non-zero exit code lets scheduled runs fail on regressions
+    return 1 if any(row['verdict'] == 'regression' for row in comparison) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,314 @@
+"""
+Translates the mongoDB query catalog into SQL on documents stored in postgres jsonb columns
+"""
+
+import json
+
+
+# Schema of the tables with one jsonb document per row
+SCHEMA = 'documents'
+
+# Alias of the collection a query starts from
+ROOT = 'root'
+
+COMPARISONS = {'$gt': '>', '$gte': '>=', '$lt': '<', '$lte': '<='}
+
+ACCUMULATORS = {'$sum': 'sum', '$avg': 'avg', '$min': 'min', '$max': 'max'}
+
+
+def table_name(collection):
+    return '{}.{}'.format(SCHEMA, collection)
+
+
+def quote_literal(text, parameterized=False):
+
+    # Placeholders of a parameterized query are filled with mogrify, literal percent signs are doubled
+    literal = "'{}'".format(text.replace("'", "''"))
+
+    return literal.replace('%', '%%') if parameterized else literal
+
+
+def is_parameter(value):
+    return isinstance(value, dict) and (list(value.keys()) == ['$param'])
+
+
+class JsonbQuery:
+
+    """
+    Class designed to build one SQL statement from a find or aggregate query, joins come from $lookup with $unwind
+    """
+
+    def __init__(self, spec, parameterized=False):
+        self.parameterized = parameterized
+        self.joins = []
+        self.aliases = []
+        self.where = []
+        self.columns = None
+        self.group_by = None
+        self.order_by = []
+        self.limit = None
+        self.offset = None
+        self.source = 'FROM {} AS "{}"'.format(table_name(spec['collection']), ROOT)
+
+        # Alias of the document that field paths without a join alias refer to
+        self.base = ROOT
+
+    def split_path(self, path):
+
+        # Fields of a looked up document start with the alias of its join
+        parts = path.split('.')
+        if (len(parts) > 1) and (parts[0] in self.aliases):
+            return parts[0], parts[1:]
+
+        return self.base, parts
+
+    def field(self, path):
+
+        alias, parts = self.split_path(path)
+        if len(parts) == 1:
+            return '"{}".doc->{}'.format(alias, quote_literal(parts[0], self.parameterized))
+
+        return '"{}".doc#>{}'.format(alias, quote_literal('{' + ','.join(parts) + '}', self.parameterized))
+
+    def value(self, value):
+
+        # Values without a JSON form, such as dates, are not translated
+        try:
+            text = json.dumps(value)
+        except TypeError:
+            raise ValueError('Unsupported value {}'.format(value))
+
+        return quote_literal(text, self.parameterized) + '::jsonb'
+
+    def containment(self, path, value):
+
+        # Equality as containment, so the GIN index of the table can answer it
+        alias, parts = self.split_path(path)
+        for part in reversed(parts):
+            value = {part: value}
+
+        return '"{}".doc @> {}'.format(alias, self.value(value))
+
+    def expression(self, value):
+
+        # Values of $project and $group: a field path, or a constant
+        if isinstance(value, str) and value.startswith('$'):
+            return self.field(value[1:])
+
+        if isinstance(value, dict):
+            if any(key.startswith('$') for key in value):
+                raise ValueError('Unsupported expression {}'.format(value))
+            return 'jsonb_build_object({})'.format(', '.join('{}, {}'.format(quote_literal(key, self.parameterized), self.expression(item)) for key, item in value.items()))
+
+        return self.value(value)
+
+    def condition(self, path, value):
+
+        if not (isinstance(value, dict) and any(key.startswith('$') for key in value)):
+            return self.containment(path, value)
+
+        conditions = []
+        for operator, operand in value.items():
+            if is_parameter(operand) and (operator not in ['$in', '$nin']):
+                raise ValueError('Parameters are only translated in $in and $nin')
+            if operator == '$eq':
+                conditions.append(self.containment(path, operand))
+            elif operator == '$ne':
+                conditions.append('NOT ({})'.format(self.containment(path, operand)))
+            elif operator in ['$in', '$nin']:
+                if is_parameter(operand):
+                    # The values are bound as jsonb, so they compare with the field whatever their type
+                    condition = '{} IN %({})s'.format(self.field(path), operand['$param'])
+                elif len(operand) == 0:
+                    condition = 'false'
+                else:
+                    condition = '({})'.format(' OR '.join(self.containment(path, item) for item in operand))
+                conditions.append(condition if operator == '$in' else 'NOT {}'.format(condition))
+            elif operator in COMPARISONS:
+                conditions.append('{} {} {}'.format(self.field(path), COMPARISONS[operator], self.value(operand)))
+            elif operator == '$exists':
+                conditions.append('{} IS {}NULL'.format(self.field(path), 'NOT ' if operand else ''))
+            else:
+                raise ValueError('Unsupported operator {}'.format(operator))
+
+        return ' AND '.join(conditions)
+
+    def predicate(self, match):
+
+        conditions = []
+        for key, value in match.items():
+            if key == '$and':
+                conditions.append('({})'.format(' AND '.join(self.predicate(branch) for branch in value)))
+            elif key == '$or':
+                conditions.append('({})'.format(' OR '.join(self.predicate(branch) for branch in value)))
+            elif key == '$nor':
+                conditions.append('NOT ({})'.format(' OR '.join(self.predicate(branch) for branch in value)))
+            elif key.startswith('$'):
+                raise ValueError('Unsupported operator {}'.format(key))
+            else:
+                conditions.append(self.condition(key, value))
+
+        return ' AND '.join(conditions) if len(conditions) > 0 else 'true'
+
+    def add_lookup(self, lookup, unwind):
+
+        if (unwind is None) or (unwind['path'] != '$' + lookup['as']):
+            raise ValueError('A $lookup is only translated when the next stage unwinds it')
+
+        join = 'LEFT JOIN' if unwind.get('preserveNullAndEmptyArrays', False) else 'INNER JOIN'
+        local = self.field(lookup['localField'])
+        self.aliases.append(lookup['as'])
+        conditions = ['{} = {}'.format(self.field(lookup['as'] + '.' + lookup['foreignField']), local)]
+
+        # A pipeline of $match stages filters the looked up documents, its fields refer to the joined table
+        self.base = lookup['as']
+        for stage in lookup.get('pipeline', []):
+            if list(stage.keys()) != ['$match']:
+                raise ValueError('Only $match stages are translated in the pipeline of a $lookup')
+            conditions.append(self.predicate(stage['$match']))
+        self.base = ROOT
+
+        self.joins.append('{} {} AS "{}" ON {}'.format(join, table_name(lookup['from']), lookup['as'], ' AND '.join(conditions)))
+
+    def add_projection(self, projection):
+
+        # Excluded fields are removed from the document, included and computed fields become columns
+        if all(value in [0, False] for value in projection.values()):
+            self.columns = ['"{}".doc - {}::text[] AS doc'.format(ROOT, quote_literal('{' + ','.join(projection) + '}', self.parameterized))]
+            return
+
+        columns = []
+        if projection.get('_id', 1) not in [0, False]:
+            columns.append('{} AS "_id"'.format(self.field('_id')))
+        for name, value in projection.items():
+            if name == '_id':
+                continue
+            if value in [1, True]:
+                columns.append('{} AS "{}"'.format(self.field(name), name))
+            elif value in [0, False]:
+                raise ValueError('Projections cannot mix included and excluded fields')
+            else:
+                columns.append('{} AS "{}"'.format(self.expression(value), name))
+        self.columns = columns
+
+    def add_group(self, group):
+
+        columns = []
+        key = group['_id']
+        if key is not None:
+            columns.append('{} AS "_id"'.format(self.expression(key)))
+            self.group_by = 'GROUP BY 1'
+        else:
+            columns.append('NULL AS "_id"')
+            self.group_by = ''
+
+        for name, accumulator in group.items():
+            if name == '_id':
+                continue
+            operator, operand = list(accumulator.items())[0]
+            if operator not in ACCUMULATORS:
+                raise ValueError('Unsupported accumulator {}'.format(operator))
+            if (operator == '$sum') and (operand == 1):
+                columns.append('count(*) AS "{}"'.format(name))
+            elif operator in ['$min', '$max']:
+                columns.append('{}({}) AS "{}"'.format(ACCUMULATORS[operator], self.expression(operand), name))
+            else:
+                columns.append('{}(({} #>> {})::numeric) AS "{}"'.format(ACCUMULATORS[operator], self.expression(operand), quote_literal('{}'), name))
+        self.columns = columns
+
+    def add_sort(self, sort):
+
+        # Natural order has no SQL equivalent, the rows come in scan order
+        for name, direction in sort:
+            if name == '$natural':
+                continue
+            target = '"{}"'.format(name) if self.columns is not None else self.field(name)
+            self.order_by.append('{} {}'.format(target, 'ASC' if direction == 1 else 'DESC'))
+
+    def to_sql(self):
+
+        # Without a projection the document is returned with the looked up documents embedded, as mongoDB does
+        if self.columns is None:
+            document = '"{}".doc'.format(ROOT)
+            for alias in self.aliases:
+                document += ' || jsonb_build_object({}, "{}".doc)'.format(quote_literal(alias, self.parameterized), alias)
+            columns = ['{} AS doc'.format(document)]
+        else:
+            columns = self.columns
+
+        sql = 'SELECT {}\n{}'.format(', '.join(columns), self.source)
+        for join in self.joins:
+            sql += '\n' + join
+        if len(self.where) > 0:
+            sql += '\nWHERE ' + ' AND '.join(self.where)
+        if self.group_by:
+            sql += '\n' + self.group_by
+        if len(self.order_by) > 0:
+            sql += '\nORDER BY ' + ', '.join(self.order_by)
+        if self.limit is not None:
+            sql += '\nLIMIT {}'.format(int(self.limit))
+        if self.offset is not None:
+            sql += '\nOFFSET {}'.format(int(self.offset))
+
+        return sql
+
+
+def translate_query(spec, parameterized=False):
+
+    """
+    Translates a query of the mongoDB catalog into SQL on the jsonb tables, raises ValueError for stages
+    and operators without a translation
+    """
+
+    query = JsonbQuery(spec, parameterized)
+
+    if spec['method'] == 'find':
+        if spec.get('filter'):
+            query.where.append(query.predicate(spec['filter']))
+        query.add_sort(spec.get('sort', []))
+        if spec.get('projection'):
+            query.add_projection(spec['projection'])
+        return query.to_sql()
+
+    # Stages that shape the output end the part of the pipeline that filters and joins
+    pipeline = spec['pipeline']
+    shaped = False
+    i = 0
+    while i < len(pipeline):
+        stage, value = list(pipeline[i].items())[0]
+        if stage == '$lookup' and not shaped:
+            query.add_lookup(value, pipeline[i+1]['$unwind'] if (i+1 < len(pipeline)) and ('$unwind' in pipeline[i+1]) else None)
+            i += 1
+        elif stage == '$match' and not shaped:
+            query.where.append(query.predicate(value))
+        elif stage == '$project' and not shaped:
+            query.add_projection(value)
+            shaped = True
+        elif stage == '$group' and not shaped:
+            query.add_group(value)
+            shaped = True
+        elif stage == '$sort' and (len(query.order_by) == 0) and (query.limit is None):
+            query.add_sort(value.items())
+        elif stage == '$skip' and (query.limit is None) and (query.offset is None):
+            query.offset = value
+        elif stage == '$limit' and (query.limit is None):
+            query.limit = value
+        else:
+            raise ValueError('Unsupported stage {} at position {}'.format(stage, i))
+        i += 1
+
+    return query.to_sql()
+
+
+def lookup_indexes(specs):
+
+    # Fields that queries join on, per collection, they get an expression index after each import
+    indexes = {}
+    for spec in specs:
+        if (spec is None) or (spec.get('method') != 'aggregate'):
+            continue
+        for stage in spec['pipeline']:
+            if '$lookup' in stage:
+                indexes.setdefault(stage['$lookup']['from'], set()).add(stage['$lookup']['foreignField'])
+
+    return {collection: sorted(fields) for collection, fields in indexes.items()}
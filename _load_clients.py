@@ -0,0 +1,139 @@
+import time
+import queue
+import multiprocessing
+import psycopg2
+import pymongo
+from pymongo.read_concern import ReadConcern
+from _histogram import LatencyHistogram
+
+
+def run_load(run, interval, stop, done):
+
+    # Repeat the query until stopped, in a closed loop or every interval ms, and record the latencies of the completed queries
+    histogram = LatencyHistogram()
+    next_start = time.time()
+    while not stop.is_set():
+        if interval is not None:
+            # A client that falls behind does not catch up, the requests it skipped are corrected for in the histogram
+            time.sleep(max(next_start - time.time(), 0))
+            next_start = max(next_start, time.time()) + interval/1000
+
+        start = time.time()
+        if run():
+            histogram.record((time.time()-start)*1000, interval)
+
+    done.put(histogram.to_dict())
+
+
+def postgres_load_client(postgres_settings, query, settings, interval, ready, stop, done):
+
+    con = psycopg2.connect(**postgres_settings)
+    cur = con.cursor()
+    ready.put(True)
+
+    # Run the query with the same session settings as the timed client
+    def run():
+        try:
+            for name, value in settings.items():
+                cur.execute("SELECT set_config(%s, %s, true)", (name, value))
+            cur.execute(query)
+            cur.fetchall()
+            completed = True
+        except psycopg2.Error:
+            completed = False
+        con.rollback()
+        return completed
+
+    run_load(run, interval, stop, done)
+    con.close()
+
+
+def mongodb_load_client(host, database, spec, options, kwargs, interval, ready, stop, done):
+
+    # Only a configured compressor is passed, pymongo rejects compressors=None
+    compressors = options.get('compressors')
+    client = pymongo.MongoClient(host) if compressors is None else pymongo.MongoClient(host, compressors=compressors)
+    mycol = client[database][spec['collection']]
+    if 'readConcern' in options:
+        mycol = mycol.with_options(read_concern=ReadConcern(options['readConcern']))
+    ready.put(True)
+
+    # Run the query with the same options as the timed client
+    def run():
+        try:
+            if spec['method'] == 'find':
+                mydoc = mycol.find(spec['filter'], spec.get('projection'), **kwargs)
+                if 'sort' in spec:
+                    mydoc = mydoc.sort([tuple(key) for key in spec['sort']])
+            else:
+                mydoc = mycol.aggregate(spec['pipeline'], **kwargs)
+            [i for i in mydoc]
+            return True
+        except pymongo.errors.PyMongoError:
+            return False
+
+    run_load(run, interval, stop, done)
+    client.close()
+
+
+class LoadClients:
+
+    """
+    Class designed to run concurrent clients in separate processes that repeat a query while the trials are timed
+    """
+
+    def __init__(self, clients, target, args):
+        self.clients = clients
+        self.target = target
+        self.args = args
+        self.context = multiprocessing.get_context('spawn')
+        self.processes = []
+        self.stop_event = None
+        self.done = None
+
+        # Time in s from the moment all clients are connected until they are stopped, the queries per second follow from it
+        self.started = None
+        self.elapsed = None
+
+    def start(self, timeout=60):
+
+        ready = self.context.Queue()
+        self.done = self.context.Queue()
+        self.stop_event = self.context.Event()
+
+        for client in range(self.clients):
+            process = self.context.Process(target=self.target, args=self.args + (ready, self.stop_event, self.done), daemon=True)
+            process.start()
+            self.processes.append(process)
+
+        # Wait until every client is connected
+        try:
+            for client in range(self.clients):
+                ready.get(timeout=timeout)
+        except queue.Empty:
+            self.stop()
+            raise RuntimeError('Load clients did not connect within {} s'.format(timeout))
+
+        self.started = time.time()
+
+    def stop(self, timeout=60):
+
+        # Clients finish their current query before they stop
+        self.stop_event.set()
+        self.elapsed = time.time() - self.started if self.started is not None else None
+
+        # Merge the latencies of all clients
+        histogram = LatencyHistogram()
+        for process in self.processes:
+            try:
+                histogram.merge(LatencyHistogram.from_dict(self.done.get(timeout=timeout)))
+            except queue.Empty:
+                pass
+
+        for process in self.processes:
+            process.join(timeout=1)
+            if process.is_alive():
+                process.terminate()
+        self.processes = []
+
+        return histogram
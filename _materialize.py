@@ -0,0 +1,245 @@
+"""
+Converts raw query results into typed columns: a dictionary of NumPy arrays, or an Arrow table when pyarrow is installed
+"""
+
+import struct
+import datetime
+import importlib.util
+import numpy as np
+import bson
+
+
+# Postgres types with a fixed width in the binary COPY format, by type oid
+PG_FIXED_TYPES = {16: np.dtype('?'),      # bool
+                  21: np.dtype('>i2'),    # int2
+                  23: np.dtype('>i4'),    # int4
+                  20: np.dtype('>i8'),    # int8
+                  700: np.dtype('>f4'),   # float4
+                  701: np.dtype('>f8'),   # float8
+                  1082: np.dtype('>i4'),  # date, days since 2000-01-01
+                  1114: np.dtype('>i8'),  # timestamp, microseconds since 2000-01-01
+                  1184: np.dtype('>i8')}  # timestamptz, microseconds since 2000-01-01
+
+# Postgres text types, by type oid
+PG_TEXT_TYPES = [25, 1042, 1043, 19]
+
+PG_NUMERIC = 1700
+
+# Postgres JSON types, by type oid, with the offset of the JSON text in the binary value (jsonb starts with a version byte)
+PG_JSON_TYPES = {114: 0,    # json
+                 3802: 1}   # jsonb
+
+PG_COPY_SIGNATURE = b'PGCOPY\n\xff\r\n\x00'
+
+
+def unique_names(names):
+
+    # Joins can return the same column name twice, number the repeats
+    unique = []
+    repeats = {}
+    for name in names:
+        if name in repeats:
+            repeats[name] += 1
+            unique.append('{}_{}'.format(name, repeats[name]))
+        else:
+            repeats[name] = 0
+            unique.append(name)
+
+    return unique
+
+
+def to_array(values):
+
+    # Pick the narrowest NumPy type that holds every value, missing values become NaN, NaT or None
+    present = [value for value in values if value is not None]
+    kinds = set(type(value) for value in present)
+
+    if len(present) > 0:
+        if kinds == {bool} and len(present) == len(values):
+            return np.array(values, dtype=bool)
+        if kinds == {int} and len(present) == len(values):
+            try:
+                return np.array(values, dtype=np.int64)
+            except OverflowError:
+                pass
+        elif kinds <= {int, float}:
+            return np.array([np.nan if value is None else value for value in values], dtype=np.float64)
+        if kinds == {datetime.datetime}:
+            return np.array([np.datetime64('NaT') if value is None else value for value in values], dtype='datetime64[us]')
+
+    array = np.empty(len(values), dtype=object)
+    array[:] = values
+
+    return array
+
+
+def decode_numeric(value):
+
+    # Binary numeric is a list of base 10000 digits, converted to a float
+    ndigits, weight, sign, dscale = struct.unpack_from('>hhHh', value)
+    if sign == 0xC000:
+        return float('nan')
+    if sign == 0xD000:
+        return float('inf')
+    if sign == 0xF000:
+        return float('-inf')
+
+    number = 0
+    for digit in struct.unpack_from('>{}H'.format(ndigits), value, 8):
+        number = number*10000 + digit
+    number = number * 10000.0**(weight-ndigits+1)
+
+    return -number if sign == 0x4000 else number
+
+
+def fixed_to_array(data, nulls, dtype, type_oid):
+
+    array = np.frombuffer(data, dtype=dtype).astype(dtype.newbyteorder('='))
+
+    if type_oid == 1082:
+        array = np.datetime64('2000-01-01', 'D') + array.astype('timedelta64[D]')
+    elif type_oid in [1114, 1184]:
+        array = np.datetime64('2000-01-01', 'us') + array.astype('timedelta64[us]')
+
+    if len(nulls) == 0:
+        return array
+
+    if array.dtype.kind == 'M':
+        array[nulls] = np.datetime64('NaT')
+    elif array.dtype.kind == 'b':
+        array = array.astype(object)
+        array[nulls] = None
+    else:
+        array = array.astype(np.float64)
+        array[nulls] = np.nan
+
+    return array
+
+
+def decode_pg_binary(data, names, type_oids):
+
+    """
+    Decodes the output of COPY ... TO STDOUT WITH (FORMAT binary) into a dictionary of NumPy arrays
+    """
+
+    view = memoryview(data)
+    if bytes(view[:11]) != PG_COPY_SIGNATURE:
+        raise ValueError('Not a binary COPY stream')
+
+    # Skip the flags and the header extension
+    offset = 19 + struct.unpack_from('>i', view, 15)[0]
+
+    unpack_short = struct.Struct('>h').unpack_from
+    unpack_int = struct.Struct('>i').unpack_from
+
+    # Fixed width values are collected as raw bytes, other values as Python objects
+    fixed = [PG_FIXED_TYPES.get(type_oid) for type_oid in type_oids]
+    text = [type_oid in PG_TEXT_TYPES for type_oid in type_oids]
+    json_offsets = [PG_JSON_TYPES.get(type_oid) for type_oid in type_oids]
+    columns = [bytearray() if dtype is not None else [] for dtype in fixed]
+    nulls = [[] for type_oid in type_oids]
+
+    rows = 0
+    while True:
+        count = unpack_short(view, offset)[0]
+        offset += 2
+        if count == -1:
+            break
+
+        for i in range(count):
+            length = unpack_int(view, offset)[0]
+            offset += 4
+
+            if length == -1:
+                nulls[i].append(rows)
+                if fixed[i] is not None:
+                    columns[i] += bytes(fixed[i].itemsize)
+                else:
+                    columns[i].append(None)
+            elif fixed[i] is not None:
+                columns[i] += view[offset:offset+length]
+            elif text[i]:
+                columns[i].append(str(view[offset:offset+length], 'utf-8'))
+            elif json_offsets[i] is not None:
+                columns[i].append(str(view[offset+json_offsets[i]:offset+length], 'utf-8'))
+            elif type_oids[i] == PG_NUMERIC:
+                columns[i].append(decode_numeric(view[offset:offset+length]))
+            else:
+                columns[i].append(bytes(view[offset:offset+length]))
+
+            if length > 0:
+                offset += length
+
+        rows += 1
+
+    arrays = {}
+    for name, column, dtype, type_oid, column_nulls in zip(unique_names(names), columns, fixed, type_oids, nulls):
+        arrays[name] = fixed_to_array(column, column_nulls, dtype, type_oid) if dtype is not None else to_array(column)
+
+    return arrays
+
+
+class ColumnBuilder:
+
+    """
+    Collects documents from raw BSON batches into columns, one batch of documents is decoded at a time
+    """
+
+    def __init__(self):
+        self.columns = {}
+        self.rows = 0
+
+    def add_batch(self, data):
+
+        for document in bson.decode_all(data):
+            for name, value in document.items():
+                if name not in self.columns:
+                    self.columns[name] = [None]*self.rows
+                self.columns[name].append(value)
+            self.rows += 1
+
+            # Fields missing from the document are missing values
+            for column in self.columns.values():
+                if len(column) < self.rows:
+                    column.append(None)
+
+    def to_arrays(self):
+
+        return {name: to_array(column) for name, column in self.columns.items()}
+
+
+def count_rows(result):
+
+    # Rows of a result in any of the materializations, Arrow tables are recognised without importing pyarrow
+    if isinstance(result, dict):
+        return len(next(iter(result.values()))) if len(result) > 0 else 0
+
+    if hasattr(result, 'num_rows'):
+        return result.num_rows
+
+    return len(result)
+
+
+def has_pyarrow():
+
+    # Whether pyarrow is installed, without the time of importing it
+    return importlib.util.find_spec('pyarrow') is not None
+
+
+def to_arrow(arrays):
+
+    # pyarrow is only imported by the Arrow materialization, so it does not slow down the start of a run
+    try:
+        import pyarrow
+    except ImportError:
+        raise ImportError('Arrow materialization requires pyarrow')
+
+    columns = {}
+    for name, array in arrays.items():
+        try:
+            columns[name] = pyarrow.array(array)
+        except (pyarrow.ArrowInvalid, pyarrow.ArrowTypeError):
+            # Types without an Arrow equivalent, such as ObjectId, are stored as strings
+            columns[name] = pyarrow.array([None if value is None else str(value) for value in array])
+
+    return pyarrow.table(columns)
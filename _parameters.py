@@ -0,0 +1,79 @@
+"""
+Fills the parameters of the parameterized query catalog with values drawn from pools sampled from the loaded data
+"""
+
+import re
+import copy
+
+
+# Named placeholders of psycopg2 in the SQL catalog, e.g. pd_desc IN %(pd_desc)s
+SQL_PARAMETER = re.compile(r'%\((\w+)\)s')
+
+
+def find_parameters(query):
+
+    # Names of the parameters of a SQL string or of a mongoDB query, where a parameter is written as {"$param": name}
+    if query is None:
+        return []
+
+    if isinstance(query, str):
+        return sorted(set(SQL_PARAMETER.findall(query)))
+
+    names = set()
+    if isinstance(query, dict):
+        if list(query.keys()) == ['$param']:
+            return [query['$param']]
+        for value in query.values():
+            names.update(find_parameters(value))
+    elif isinstance(query, list):
+        for value in query:
+            names.update(find_parameters(value))
+
+    return sorted(names)
+
+
+def bind_parameters(spec, values):
+
+    # Replace each {"$param": name} of a mongoDB query by its list of values, for use with $in
+    if isinstance(spec, dict):
+        if list(spec.keys()) == ['$param']:
+            return list(values[spec['$param']])
+        return {key: bind_parameters(value, values) for key, value in spec.items()}
+
+    if isinstance(spec, list):
+        return [bind_parameters(value, values) for value in spec]
+
+    return copy.copy(spec)
+
+
+def choose_values(values, counts, fraction, rng, contiguous=False):
+
+    """
+    Draws values from a pool of distinct values with their row counts, so that the rows with one of the values
+    are close to the fraction of the rows. Without a fraction one random value is drawn. Contiguous pools,
+    such as years, get a range of neighbouring values from a random start
+    """
+
+    if fraction is None:
+        return [values[int(rng.integers(len(values)))]]
+
+    target = fraction * sum(counts)
+
+    if contiguous:
+        # Extend the range upwards from the start, and downwards when the end of the pool is reached
+        start = int(rng.integers(len(values)))
+        order = list(range(start, len(values))) + list(range(start-1, -1, -1))
+    else:
+        order = rng.permutation(len(values))
+
+    # Add values while they bring the rows closer to the target, at least one value is always drawn
+    chosen = []
+    total = 0
+    for index in order:
+        if (len(chosen) == 0) or (abs(total + counts[index] - target) < abs(total - target)):
+            chosen.append(index)
+            total += counts[index]
+        elif contiguous:
+            break
+
+    return [values[index] for index in sorted(chosen)]
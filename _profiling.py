@@ -0,0 +1,109 @@
+"""
+Profiles runs of a query in the client, to attribute its time to the drivers, the network and the Python code around them
+"""
+
+import os
+import sys
+import time
+import pstats
+import cProfile
+import threading
+from collections import Counter
+
+
+# Functions that wait for the server: socket reads and writes, and the psycopg2 calls that send a query and wait for its result
+NETWORK_FUNCTIONS = ["'_socket.socket'", "'_ssl._SSLSocket'", 'select.', "'execute' of 'psycopg2", "'copy_expert' of 'psycopg2"]
+
+# Modules of the drivers, including their C extensions that build tuples and decode BSON
+DRIVER_MODULES = ['psycopg2', 'pymongo', 'bson']
+
+
+def classify(function):
+
+    # Category of a function of the cProfile statistics, by its (filename, line, name) key
+    filename, line, name = function
+    if any(pattern in name for pattern in NETWORK_FUNCTIONS):
+        return 'network'
+
+    # Built-in functions have no file, their name holds the module, e.g. <method 'fetchall' of 'psycopg2.extensions.cursor' objects>
+    if filename == '~':
+        return 'driver' if any(module + '.' in name for module in DRIVER_MODULES) else 'user'
+
+    return 'driver' if any(module in filename.replace('\\', '/').split('/') for module in DRIVER_MODULES) else 'user'
+
+
+def frame_label(frame):
+    return '{}:{}'.format(os.path.basename(frame.f_code.co_filename), frame.f_code.co_name)
+
+
+class QueryProfiler:
+
+    """
+    Class designed to profile a function call with cProfile while a thread samples its stack, the samples give a
+    flamegraph in the collapsed stack format and the cProfile statistics the time per category
+    """
+
+    def __init__(self, interval=1):
+        self.interval = interval/1000
+        self.profile = cProfile.Profile()
+        self.samples = Counter()
+        self.wall_time = 0
+        self.runs = 0
+
+        # Whether the profiled call is running, samples taken after it returned are dropped
+        self.active = False
+
+    def sample(self, thread_id, root, stop):
+
+        # Stacks from the profiled call down to the running frame, the frames of the caller are left out
+        while not stop.wait(self.interval):
+            frame = sys._current_frames().get(thread_id)
+            stack = []
+            while (frame is not None) and (frame is not root):
+                stack.append(frame_label(frame))
+                frame = frame.f_back
+            if (frame is root) and self.active:
+                self.samples[';'.join(reversed(stack))] += 1
+
+    def run(self, function):
+
+        stop = threading.Event()
+        sampler = threading.Thread(target=self.sample, args=(threading.get_ident(), sys._getframe(), stop), daemon=True)
+        sampler.start()
+
+        start = time.time()
+        self.active = True
+        self.profile.enable()
+        try:
+            return function()
+        finally:
+            self.profile.disable()
+            self.active = False
+            self.wall_time += (time.time()-start)*1000
+            self.runs += 1
+            stop.set()
+            sampler.join()
+
+    def summary(self):
+
+        # Own time per category in ms, the network time includes the time the server spends on the query
+        times = {'driver': 0, 'network': 0, 'user': 0}
+        if self.runs > 0:
+            for function, (calls, primitive_calls, own_time, cumulative_time, callers) in pstats.Stats(self.profile).stats.items():
+                times[classify(function)] += own_time*1000
+
+        return {'runs': self.runs,
+                'wall_time': self.wall_time,
+                'driver_time': times['driver'],
+                'network_time': times['network'],
+                'user_time': times['user'],
+                'samples': sum(self.samples.values())}
+
+    def write(self, path, name):
+
+        # A .pstats file for pstats or snakeviz and a .collapsed file for flamegraph.pl or speedscope
+        os.makedirs(path, exist_ok=True)
+        self.profile.dump_stats(os.path.join(path, name + '.pstats'))
+        with open(os.path.join(path, name + '.collapsed'), 'w') as handle:
+            for stack, count in self.samples.most_common():
+                handle.write('{} {}\n'.format(stack, count))
@@ -0,0 +1,196 @@
+"""
+Rewrites the mongoDB query catalog into an optimized form that returns the same documents
+"""
+
+import copy
+
+
+def split_predicates(match):
+
+    # Split a $match document into predicates that must all hold
+    predicates = []
+    for key, value in match.items():
+        if key == '$and':
+            for branch in value:
+                predicates += split_predicates(branch)
+        else:
+            predicates.append({key: value})
+
+    return predicates
+
+
+def join_predicates(predicates):
+
+    # Combine predicates into one $match document, use $and only when fields repeat
+    match = {}
+    for predicate in predicates:
+        if any(key in match for key in predicate):
+            return {'$and': predicates}
+        match.update(predicate)
+
+    return match
+
+
+def or_to_in(predicate):
+
+    # Convert an $or of equalities on one field to $in
+    if list(predicate.keys()) != ['$or']:
+        return predicate
+
+    field = None
+    values = []
+    for branch in predicate['$or']:
+        if (len(branch) != 1) or list(branch.keys())[0].startswith('$'):
+            return predicate
+        key, value = list(branch.items())[0]
+        if isinstance(value, dict):
+            if list(value.keys()) != ['$eq']:
+                return predicate
+            value = value['$eq']
+        if (field is not None) and (key != field):
+            return predicate
+        field = key
+        values.append(value)
+
+    return {field: {'$in': values}}
+
+
+def predicate_fields(predicate):
+
+    # List the fields a predicate filters on, None if it cannot be analysed
+    fields = []
+    for key, value in predicate.items():
+        if key in ['$and', '$or', '$nor']:
+            for branch in value:
+                branch_fields = predicate_fields(branch)
+                if branch_fields is None:
+                    return None
+                fields += branch_fields
+        elif key.startswith('$'):
+            return None
+        else:
+            fields.append(key)
+
+    return fields
+
+
+def strip_prefix(predicate, prefix):
+
+    # Rewrite field paths relative to a looked up document
+    stripped = {}
+    for key, value in predicate.items():
+        if key in ['$and', '$or', '$nor']:
+            stripped[key] = [strip_prefix(branch, prefix) for branch in value]
+        else:
+            stripped[key[len(prefix)+1:]] = value
+
+    return stripped
+
+
+def on_path(field, path):
+
+    return (field == path) or field.startswith(path + '.')
+
+
+def push_ahead(stages, predicate):
+
+    # Move a predicate on local fields in front of the $lookup and $unwind stages that precede it
+    fields = predicate_fields(predicate)
+    if fields is None:
+        return False
+
+    index = len(stages)
+    while index > 0:
+        stage = stages[index-1]
+        if '$lookup' in stage:
+            path = stage['$lookup']['as']
+        elif '$unwind' in stage:
+            unwind = stage['$unwind']
+            path = (unwind['path'] if isinstance(unwind, dict) else unwind)[1:]
+        elif '$match' in stage:
+            index -= 1
+            continue
+        else:
+            break
+        if any(on_path(field, path) for field in fields):
+            break
+        index -= 1
+
+    # Only rewrite when the predicate passes at least one join
+    if not any('$lookup' in stage for stage in stages[index:]):
+        return False
+
+    if (index > 0) and ('$match' in stages[index-1]):
+        stages[index-1] = {'$match': join_predicates(split_predicates(stages[index-1]['$match']) + [predicate])}
+    else:
+        stages.insert(index, {'$match': predicate})
+
+    return True
+
+
+def push_into_lookup(stages, predicate):
+
+    # Move a predicate on joined fields into the sub-pipeline of the $lookup, when an $unwind
+    # without preserveNullAndEmptyArrays drops the documents that no longer have a match
+    fields = predicate_fields(predicate)
+    if (fields is None) or (len(fields) == 0):
+        return False
+
+    unwound = None
+    for stage in reversed(stages):
+        if '$unwind' in stage:
+            unwind = stage['$unwind']
+            if isinstance(unwind, dict):
+                path = unwind['path'][1:]
+                preserve = unwind.get('preserveNullAndEmptyArrays', False)
+            else:
+                path = unwind[1:]
+                preserve = False
+            if any(on_path(field, path) for field in fields):
+                if (not all(on_path(field, path) for field in fields)) or preserve:
+                    return False
+                unwound = path
+        elif '$lookup' in stage:
+            lookup = stage['$lookup']
+            if any(on_path(field, lookup['as']) for field in fields):
+                if (not all(on_path(field, lookup['as']) for field in fields)) or (unwound != lookup['as']) or (lookup['as'] in fields):
+                    return False
+                lookup['pipeline'] = lookup.get('pipeline', []) + [{'$match': strip_prefix(predicate, lookup['as'])}]
+                return True
+        elif '$match' not in stage:
+            return False
+
+    return False
+
+
+def optimize_pipeline(pipeline):
+
+    stages = []
+    for stage in copy.deepcopy(pipeline):
+
+        if '$match' not in stage:
+            stages.append(stage)
+            continue
+
+        remaining = []
+        for predicate in split_predicates(stage['$match']):
+            predicate = or_to_in(predicate)
+            if not (push_into_lookup(stages, predicate) or push_ahead(stages, predicate)):
+                remaining.append(predicate)
+
+        if len(remaining) > 0:
+            stages.append({'$match': join_predicates(remaining)})
+
+    return stages
+
+
+def optimize_query(spec):
+
+    spec = copy.deepcopy(spec)
+
+    if spec['method'] == 'find':
+        spec['filter'] = join_predicates([or_to_in(predicate) for predicate in split_predicates(spec['filter'])])
+    else:
+        spec['pipeline'] = optimize_pipeline(spec['pipeline'])
+
+    return spec
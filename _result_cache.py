@@ -0,0 +1,63 @@
+import pickle
+from collections import OrderedDict
+
+class ResultCache:
+
+    """
+    Least recently used cache of serialized query results, capped on the total size in bytes
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+
+        if key not in self.entries:
+            self.misses += 1
+            return None
+
+        # Mark the entry as most recently used
+        self.entries.move_to_end(key)
+        self.hits += 1
+
+        return pickle.loads(self.entries[key])
+
+    def put(self, key, result):
+
+        data = pickle.dumps(result, protocol=pickle.HIGHEST_PROTOCOL)
+
+        # Results larger than the cache are not stored
+        if len(data) > self.max_bytes:
+            return False
+
+        if key in self.entries:
+            self.size -= len(self.entries.pop(key))
+
+        # Evict least recently used entries until the result fits
+        while self.size + len(data) > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= len(evicted)
+
+        self.entries[key] = data
+        self.size += len(data)
+
+        return True
+
+    def clear(self):
+
+        self.entries.clear()
+        self.size = 0
+
+    def get_stats(self):
+
+        lookups = self.hits + self.misses
+
+        return {"hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups > 0 else None,
+                "entries": len(self.entries),
+                "bytes": self.size}
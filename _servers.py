@@ -0,0 +1,278 @@
+import os
+import sys
+import time
+import signal
+import shutil
+import platform
+import tempfile
+import subprocess
+import psycopg2
+import pymongo
+
+
+def host_metadata():
+
+    # Hardware and software of the machine that runs the experiment
+    metadata = {'platform': platform.platform(),
+                'machine': platform.machine(),
+                'python': sys.version.split()[0],
+                'cpu_count': os.cpu_count(),
+                'cpu_model': None,
+                'memory_bytes': None}
+
+    try:
+        with open('/proc/cpuinfo', 'r') as file:
+            for line in file:
+                if line.startswith('model name'):
+                    metadata['cpu_model'] = line.split(':', 1)[1].strip()
+                    break
+    except OSError:
+        metadata['cpu_model'] = platform.processor()
+
+    try:
+        metadata['memory_bytes'] = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (ValueError, OSError, AttributeError):
+        pass
+
+    return metadata
+
+
+def pin_client(cpus):
+
+    # Pin the experiment process, and the load clients it starts, to a set of CPUs
+    os.sched_setaffinity(0, cpus)
+
+
+class LocalProcesses:
+
+    """
+    Class designed to run database server processes in a temporary directory, optionally pinned to a set of CPUs
+    """
+
+    def __init__(self, port, bin_path='', cpus=None):
+        self.port = port
+        self.bin_path = bin_path
+        self.cpus = cpus
+        self.path = None
+        self.processes = []
+        self.stop_signal = signal.SIGTERM
+
+    def start_process(self, name, args):
+
+        log = open(os.path.join(self.path, name + '.log'), 'w')
+
+        # Pin the server before it starts, so every process it forks runs on the same CPUs
+        preexec_fn = None if self.cpus is None else (lambda: os.sched_setaffinity(0, self.cpus))
+
+        process = subprocess.Popen(args, stdout=log, stderr=subprocess.STDOUT, preexec_fn=preexec_fn)
+        self.processes.append(process)
+
+        return process
+
+    def wait_for(self, name, process, connect):
+
+        # Wait until the process accepts connections
+        for attempt in range(120):
+            if process.poll() is not None:
+                raise RuntimeError('{} exited, see {}'.format(name, os.path.join(self.path, name + '.log')))
+            try:
+                return connect()
+            except (psycopg2.OperationalError, pymongo.errors.PyMongoError):
+                time.sleep(0.5)
+
+        raise RuntimeError('{} did not start, see {}'.format(name, os.path.join(self.path, name + '.log')))
+
+    def start_mongodb_process(self, name, args, port):
+
+        process = self.start_process(name, args + ['--port', str(port), '--bind_ip', 'localhost'])
+
+        client = pymongo.MongoClient('localhost', port, directConnection=True, serverSelectionTimeoutMS=500)
+
+        def ping():
+            client.admin.command('ping')
+            return client
+
+        return self.wait_for(name, process, ping)
+
+    def stop(self):
+
+        # Stop the processes in the reverse order of starting them
+        for process in reversed(self.processes):
+            process.send_signal(self.stop_signal)
+            try:
+                process.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        self.processes = []
+
+        if self.path is not None:
+            shutil.rmtree(self.path, ignore_errors=True)
+            self.path = None
+
+    def get_version(self, binary):
+
+        output = subprocess.run([os.path.join(self.bin_path, binary), '--version'], capture_output=True, text=True)
+
+        return output.stdout.strip().split('\n')[0]
+
+
+class LocalPostgresServer(LocalProcesses):
+
+    """
+    Class designed to run a throwaway postgres server: a cluster is initialized in a temporary directory and removed on stop
+    """
+
+    def __init__(self, port=5433, bin_path='', cpus=None, config=None):
+        super().__init__(port, bin_path, cpus)
+        self.config = {} if config is None else config
+        self.settings = None
+
+        # SIGINT is the fast shutdown of postgres, it does not wait for clients to disconnect
+        self.stop_signal = signal.SIGINT
+
+    def start(self):
+
+        self.path = tempfile.mkdtemp(prefix='postgres_')
+        data = os.path.join(self.path, 'data')
+
+        try:
+            with open(os.path.join(self.path, 'initdb.log'), 'w') as log:
+                subprocess.run([os.path.join(self.bin_path, 'initdb'), '-D', data, '-U', 'postgres', '-A', 'trust', '-E', 'UTF8', '--locale=C'],
+                               stdout=log, stderr=subprocess.STDOUT, check=True)
+
+            # The config is passed on the command line, so it overrides postgresql.conf
+            args = [os.path.join(self.bin_path, 'postgres'), '-D', data, '-p', str(self.port), '-k', self.path, '-c', 'listen_addresses=localhost']
+            for name, value in self.config.items():
+                if isinstance(value, bool):
+                    value = 'on' if value else 'off'
+                args += ['-c', '{}={}'.format(name, value)]
+            process = self.start_process('postgres', args)
+
+            self.settings = {'host': 'localhost', 'port': self.port, 'user': 'postgres', 'database': 'postgres'}
+            self.wait_for('postgres', process, lambda: psycopg2.connect(**self.settings).close())
+        except:
+            self.stop()
+            raise
+
+        print('Started local postgres server at localhost:{}'.format(self.port))
+
+    def stop(self):
+
+        super().stop()
+        self.settings = None
+
+    def get_metadata(self):
+
+        return {'version': self.get_version('postgres'),
+                'port': self.port,
+                'config': self.config,
+                'cpus': None if self.cpus is None else sorted(self.cpus)}
+
+
+class LocalMongoServer(LocalProcesses):
+
+    """
+    Class designed to run a throwaway mongoDB server with its dbpath in a temporary directory
+    """
+
+    def __init__(self, port=27018, bin_path='', cpus=None, config=None):
+        super().__init__(port, bin_path, cpus)
+        self.config = {} if config is None else config
+        self.host = None
+
+    def start(self):
+
+        self.path = tempfile.mkdtemp(prefix='mongodb_')
+        dbpath = os.path.join(self.path, 'data')
+        os.makedirs(dbpath)
+
+        # Options are passed as --name value, options set to True are passed as a flag
+        args = [os.path.join(self.bin_path, 'mongod'), '--dbpath', dbpath]
+        for name, value in self.config.items():
+            args += ['--' + name] if value is True else ['--' + name, str(value)]
+
+        try:
+            self.start_mongodb_process('mongod', args, self.port)
+        except:
+            self.stop()
+            raise
+
+        self.host = 'mongodb://localhost:{}/'.format(self.port)
+
+        print('Started local mongoDB server at {}'.format(self.host))
+
+    def stop(self):
+
+        super().stop()
+        self.host = None
+
+    def get_metadata(self):
+
+        return {'version': self.get_version('mongod'),
+                'port': self.port,
+                'config': self.config,
+                'cpus': None if self.cpus is None else sorted(self.cpus)}
+
+
+class LocalShardedCluster(LocalProcesses):
+
+    """
+    Class designed to run a sharded mongoDB cluster of local processes: a config server, one server per shard and a mongos router
+    """
+
+    def __init__(self, shards, port=27100, bin_path='', cpus=None):
+        super().__init__(port, bin_path, cpus)
+        self.shards = shards
+        self.host = None
+
+    def start_replica_set(self, name, role, port):
+
+        dbpath = os.path.join(self.path, name)
+        os.makedirs(dbpath)
+
+        client = self.start_mongodb_process(name, [os.path.join(self.bin_path, 'mongod'), role, '--replSet', name, '--dbpath', dbpath], port)
+
+        # A replica set of one member is enough for a local cluster
+        config = {'_id': name, 'members': [{'_id': 0, 'host': 'localhost:{}'.format(port)}]}
+        if role == '--configsvr':
+            config['configsvr'] = True
+        client.admin.command('replSetInitiate', config)
+
+        for attempt in range(120):
+            if client.admin.command('hello').get('isWritablePrimary'):
+                return
+            time.sleep(0.5)
+
+        raise RuntimeError('Replica set {} has no primary'.format(name))
+
+    def start(self):
+
+        self.path = tempfile.mkdtemp(prefix='mongodb_cluster_')
+
+        try:
+            # Config server
+            self.start_replica_set('config', '--configsvr', self.port)
+
+            # Shards
+            for shard in range(self.shards):
+                self.start_replica_set('shard{}'.format(shard), '--shardsvr', self.port+1+shard)
+
+            # Router
+            router_port = self.port+1+self.shards
+            client = self.start_mongodb_process('mongos', [os.path.join(self.bin_path, 'mongos'), '--configdb', 'config/localhost:{}'.format(self.port)], router_port)
+
+            for shard in range(self.shards):
+                client.admin.command('addShard', 'shard{}/localhost:{}'.format(shard, self.port+1+shard))
+        except:
+            self.stop()
+            raise
+
+        self.host = 'mongodb://localhost:{}/'.format(router_port)
+
+        print('Started local mongoDB cluster with {} shards at {}'.format(self.shards, self.host))
+
+    def stop(self):
+
+        # Stop the router first and the config server last
+        super().stop()
+        self.host = None